@@ -1,4 +1,4 @@
-import json, os, base64, asyncio, threading, sys
+import json, os, base64, asyncio, threading, sys, multiprocessing, socket
 from typing import List, Optional, AnyStr, Tuple, Any, Literal, Union, Callable, Dict
 from pathlib import Path
 from threading import Thread
@@ -15,6 +15,9 @@ from scripts.helper.util import generate_id, sha512
 from scripts.helper.database import Database
 from scripts.helper.requester import Requester
 from scripts.helper.downloader import Downloader
+from scripts.helper.progress import WatchProgressBuffer
+from scripts.helper.tokens import MediaTokenCache
+from scripts.helper.httpcache import ResponseCache
 
 class ProgramController:
     def __init__(self, prepare: bool = False):
@@ -28,6 +31,8 @@ class ProgramController:
         self.websocket_sessions: Dict[WebSocketClientProtocol, SocketSession] = {}
 
         self.database: Database = None
+        self.progress: WatchProgressBuffer = None
+        self.media_tokens: MediaTokenCache = None
 
         self.default_settings = {
             "rsa": {
@@ -36,7 +41,11 @@ class ProgramController:
             },
             "webserver": {
                 "host": "0.0.0.0",
-                "port": 5000
+                "port": 5000,
+                "mode": "threaded", # "threaded" (Flask development server) or "asgi" ("shared-loop" is accepted as well, its former name)
+                "server": "uvicorn", # ASGI server, "uvicorn" or "hypercorn"
+                "workers": 1, # ASGI worker processes, single one shares event loop with websocket server and downloader
+                "keep_alive": 5
             },
             "socketserver": {
                 "host": "0.0.0.0",
@@ -44,7 +53,13 @@ class ProgramController:
             },
             "database": {
                 "path": "data/database.db",
-                "media_token_lifetime": 3600
+                "media_token_lifetime": 3600,
+                "instrument_queries": False, # Collects timings of every query, see /debug/queries
+                "progress_flush_interval": 5 # Seconds watch progress updates are held in memory before being written
+            },
+            "http_cache": {
+                "path": "data/http-cache",
+                "memory_entries": 1024
             },
             "downloaders": {
                 "video": {
@@ -59,10 +74,11 @@ class ProgramController:
         if prepare:
             self.prepare()
 
-    async def prepare(self):
-        self.settings = self.load_settings()
+    async def prepare(self, settings: dict = None):
+        # Worker processes get settings already loaded and checked by the main process
+        self.settings = settings or self.load_settings()
 
-        self.database = Database(self.settings['database']['path'])
+        self.database = Database(self.settings['database']['path'], instrument=self.settings['database']['instrument_queries'])
         
         self.rsa = RSACipher()
         if self.settings['rsa']['keyfile'] and Path(self.settings['rsa']['keyfile']).exists():
@@ -78,6 +94,16 @@ class ProgramController:
         if not Path("data/oa-headers.json").exists():
             print(Fore.RED + "Missing headers for OglądajAnime.pl. Please provide them in data/oa-headers.json." + Color.RESET)
 
+        # Metadata changing rarely upstream, (url pattern, seconds fresh, seconds served stale while revalidating)
+        oa_cache = ResponseCache(Path(self.settings['http_cache']['path']) / "ogladajanime", [
+            (r"manager\.php\?action=get_anime_names", 6 * 3600, 24 * 3600),
+            (r"manager\.php\?action=anime\b", 3600, 6 * 3600),
+            (r"manager\.php\?action=get_player_list", 600, 3600)
+        ], max_entries=self.settings['http_cache']['memory_entries'])
+
+        if not settings:
+            oa_cache.prune()
+
         oa_requester = Requester("oa-requester",
             default_headers={
                 "Host": "ogladajanime.pl",
@@ -86,11 +112,11 @@ class ProgramController:
                 "X-Requested-With": "XMLHttpRequest",
                 **(json.loads(open("data/oa-headers.json").read()) if Path("data/oa-headers.json").exists() else {})
             },
-            max_requests_per_minute=20, max_requests_per_second=20,
+            max_requests_per_minute=20, max_requests_per_second=20, coalesce=True, cache=oa_cache,
             default_user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
         )
 
-        Requester("cda.main",
+        Requester("cda.main", coalesce=True,
          default_user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3")
 
         self.database.create_table("users", [
@@ -173,32 +199,79 @@ class ProgramController:
             "expires INTEGER NOT NULL"
         ])
 
+        # Chunk bytes live in the chunk store files, this table only indexes the stored ranges.
+        # Older databases kept the bytes in a "data" BLOB column, such table is only a cache, so it is recreated.
+        if "temporary_media_data" in self.database.tables and "data" in self.database.get_columns("temporary_media_data"):
+            with self.database.connect() as connection:
+                connection.execute("DROP TABLE temporary_media_data")
+
         self.database.create_table("temporary_media_data", [
             "id INTEGER PRIMARY KEY AUTOINCREMENT",
             "media_id INT REFERENCES media(id) NOT NULL",
             "start_byte INTEGER NOT NULL",
             "end_byte INTEGER NOT NULL",
-            "data BLOB NOT NULL",
             "UNIQUE(media_id, start_byte, end_byte)"
         ])
 
+        # Indexes for the hot access paths. Lookups by media.uid, watch_progress.user_id and temporary_media_data.media_id
+        # already use indexes of their UNIQUE constraints.
+        self.database.migrate([
+            (1, [
+                "CREATE INDEX IF NOT EXISTS media_origin_url ON media(origin_url, refer_id)",
+                "CREATE INDEX IF NOT EXISTS media_media_id ON media(media_id)",
+                "CREATE INDEX IF NOT EXISTS media_refer_type ON media(refer_id, media_type, media_duration)",
+                "CREATE INDEX IF NOT EXISTS media_tokens_token ON media_tokens(token, media_id)",
+                "CREATE INDEX IF NOT EXISTS media_tokens_media_user ON media_tokens(media_id, user_id, expires)",
+                "CREATE INDEX IF NOT EXISTS content_parent ON content(parent_uid, self_index)",
+                "ANALYZE"
+            ]),
+            (2, [
+                "CREATE INDEX IF NOT EXISTS watch_progress_user_updated ON watch_progress(user_id, updated_at)"
+            ]),
+            (3, [
+                "CREATE INDEX IF NOT EXISTS media_tokens_expires ON media_tokens(expires)"
+            ])
+        ])
+
+        for query, steps in self.database.full_scans([
+            "SELECT id FROM users WHERE id = ? AND token = ?",
+            "SELECT origin_url FROM content WHERE uid = ?",
+            "SELECT uid FROM content WHERE parent_uid = ?",
+            "SELECT id, refers_to FROM media WHERE uid = ?",
+            "SELECT id, refers_to FROM media WHERE origin_url = ? AND refer_id != ?",
+            "SELECT id, refers_to FROM media WHERE origin_url = ? AND refer_id = ?",
+            "SELECT origin_url, metadata FROM media WHERE media_id = ?",
+            "SELECT id, data_path FROM media WHERE refer_id = ? AND media_name = ?",
+            "SELECT media_duration FROM media WHERE refer_id = ? AND media_type = 'video'",
+            "SELECT MAX(expires) FROM media_tokens WHERE token = ? AND media_id = ? AND expires > ?",
+            "SELECT id FROM media_tokens WHERE expires <= ? LIMIT ?",
+            "SELECT token, expires FROM media_tokens WHERE media_id = ? AND user_id = ? AND expires > ?",
+            "SELECT content_id, progress, updated_at FROM watch_progress WHERE user_id = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            "SELECT start_byte, end_byte FROM temporary_media_data WHERE media_id = ?"
+        ]).items():
+            print(Fore.YELLOW + f"Query reads whole table ({'; '.join(steps)}): {query}" + Color.RESET)
+
         self.oa = OgladajAnime_pl(database=self.database, requester=Requester.get_requester("oa-requester"))
-        self.downloader = Downloader(self.database, [self.oa], max_downloaders=20)
+        self.media_tokens = MediaTokenCache(self.database)
+        self.progress = WatchProgressBuffer(self.database, self.settings['database']['progress_flush_interval'])
+        self.downloader = Downloader(self.database, [self.oa], max_downloaders=20, chunk_path=Path(self.settings['downloaders']['video']['path_prefix']) / ".partial",
+            media_path=self.settings['downloaders']['video']['path_prefix'])
 
         host = self.settings['socketserver']['host'] if self.settings['socketserver']['host'] != self.settings['webserver']['host'] and not self.settings['socketserver']['host'] == "0.0.0.0" else ""
         self.webserver.add_path("/", ["POST"], APIExtender(socket_host=host, socket_port=self.settings['socketserver']['port'], public_rsa_key=self.rsa.public_key()))
-        self.webserver.extend(WebExtender(database=self.database, downloader=self.downloader))
+        self.webserver.extend(WebExtender(database=self.database, downloader=self.downloader, media_tokens=self.media_tokens))
 
-        if any([arg == "--debug-mode" for arg in sys.argv]):
+        if settings or any([arg == "--debug-mode" for arg in sys.argv]):
             return True
 
         try:
+            # Not answered from the response cache, this checks the credentials still work
             data = "id=207638"
             player_list = json.loads(json.loads((await oa_requester.post(self.oa.player_list_url, headers={
                 "Referer": "https://ogladajanime.pl/anime/moja-akademia-bohaterow-6",
                 "Content-Length": str(len(data.encode())),
                 "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"
-            }, data=data))['text'])['data'])
+            }, data=data, cache=False))['text'])['data'])
 
             if not player_list['players']:
                 print(Fore.RED + "Got empty test data from OglądajAnime.pl! Exitting, please check credentials aren't being rate limited." + Color.RESET)
@@ -418,11 +491,11 @@ class ProgramController:
                 continue
 
             if data.get('action') == 'get-player-data':
-                asyncio.create_task(get_player_data(session, websocket, data, [self.oa], self.database))
+                asyncio.create_task(get_player_data(session, websocket, data, [self.oa], self.database, self.media_tokens))
                 continue
 
             if data.get('action') == 'get-media-token':
-                asyncio.create_task(get_media_token(session, websocket, data, self.database))
+                asyncio.create_task(get_media_token(session, websocket, data, self.database, self.media_tokens))
                 continue
 
             if data.get('action') == 'download-media':
@@ -430,11 +503,11 @@ class ProgramController:
                 continue
 
             if data.get('action') == 'update-watch-progress':
-                asyncio.create_task(update_watch_progress(session, websocket, data, self.database))
+                asyncio.create_task(update_watch_progress(session, websocket, data, self.database, self.progress))
                 continue
 
             if data.get('action') == 'get-watch-progress':
-                asyncio.create_task(get_watch_progress(session, websocket, data, self.database))
+                asyncio.create_task(get_watch_progress(session, websocket, data, self.database, self.progress))
                 continue
 
             print(f"Received: {data}")
@@ -445,10 +518,66 @@ class ProgramController:
             pass
 
     async def start(self):
+        if self.settings['webserver']['mode'] not in ("threaded", "asgi", "shared-loop"):
+            raise ValueError(f"Unknown webserver mode {self.settings['webserver']['mode']}!")
+
+        # "shared-loop" is the former name of asgi mode, it's the same with a single worker
+        if self.settings['webserver']['mode'] in ("asgi", "shared-loop"):
+            await self.start_asgi()
+            return
+
+        self.progress.start()
+        self.media_tokens.start()
         self.downloader.start()
         self.websocketserver.start(host=self.settings['socketserver']['host'], port=self.settings['socketserver']['port'], handler=self.handle_websocket, as_thread=True)
         threading.Thread(self.webserver.run(host=self.settings['webserver']['host'], port=self.settings['webserver']['port'])).start()
 
+    async def start_asgi(self):
+        websocketserver = self.websocketserver.serve(host=self.settings['socketserver']['host'], port=self.settings['socketserver']['port'], handler=self.handle_websocket)
+
+        self.progress.start()
+        self.media_tokens.start() # Sweeps for all workers, they only keep their own caches
+
+        try:
+            if self.settings['webserver']['workers'] <= 1:
+                # Web server, websocket server and downloader all run in this event loop
+                self.downloader.start(as_thread=False)
+                await asyncio.gather(websocketserver, self.webserver.serve(self.settings['webserver']['host'], self.settings['webserver']['port'],
+                    server=self.settings['webserver']['server'], keep_alive=self.settings['webserver']['keep_alive']))
+                return
+
+            # Workers accept connections from one shared socket, each serving them with its own event loop and downloader
+            sock = WebServer.bind(self.settings['webserver']['host'], self.settings['webserver']['port'])
+            context = multiprocessing.get_context("spawn")
+
+            for _ in range(self.settings['webserver']['workers']):
+                context.Process(target=serve_worker, args=(self.settings, sock), daemon=True).start()
+
+            await websocketserver
+        finally:
+            await Requester.close_all()
+            self.progress.stop()
+            self.media_tokens.stop()
+
+            if self.database.instrumented:
+                print(self.database.query_report())
+            self.database.close()
+
+def serve_worker(settings: dict, sock: socket.socket) -> None:
+    async def worker():
+        pc = ProgramController(prepare=False)
+        if not await pc.prepare(settings):
+            return
+
+        pc.downloader.start(as_thread=False)
+        try:
+            await pc.webserver.serve(server=settings['webserver']['server'], keep_alive=settings['webserver']['keep_alive'], sock=sock)
+        finally:
+            await Requester.close_all()
+            pc.database.close()
+
+    asyncio.run(worker())
+
 async def main():
     pc = ProgramController(prepare=False)
     if not await pc.prepare():
@@ -0,0 +1,154 @@
+import os, shutil, threading
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+from scripts.helper.database import Database
+from scripts.helper.intervals import IntervalSet
+
+class ChunkStore:
+    # Downloaded byte ranges are written into one sparse file per media, only (start, end) of every range
+    # is stored in the database, so the media bytes themselves never go through SQLite.
+
+    def __init__(self, database: Database, path: Union[str, Path], table: str = "temporary_media_data") -> None:
+        self.database: Database = database
+        self.path: Path = Path(path)
+        self.table: str = table
+
+        self._lock: threading.Lock = threading.Lock()
+        self._index: Dict[str, IntervalSet] = {}
+        self._files: Dict[str, Path] = {} # Media already promoted to their final file
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def file_path(self, media_id: Union[str, int]) -> Path:
+        return self._files.get(str(media_id)) or self.path / f"{media_id}.part"
+
+    def is_complete(self, media_id: Union[str, int]) -> bool:
+        return str(media_id) in self._files
+
+    def exists(self, media_id: Union[str, int]) -> bool:
+        return self.file_path(media_id).exists()
+
+    def write(self, media_id: Union[str, int], start: int, data: bytes, *, index: bool = True) -> Tuple[int, int]:
+        # Range written without index (e.g. a piece of a streamed download) becomes visible only after index()
+        if not data:
+            return (start, start - 1)
+
+        end = start + len(data) - 1
+
+        if self.is_complete(media_id):
+            return (start, end)
+
+        with self._lock:
+            # O_CREAT without O_TRUNC, so concurrent writers of the same media never wipe each other's ranges
+            with os.fdopen(os.open(self.file_path(media_id), os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)), "r+b") as file:
+                file.seek(start)
+                file.write(data)
+
+        if index:
+            self.index(media_id, start, end)
+
+        return (start, end)
+
+    def index(self, media_id: Union[str, int], start: int, end: int) -> None:
+        # Index is written only after the bytes are on disk, so anyone seeing the range can read it
+        if end < start or self.is_complete(media_id):
+            return
+
+        with self.database.connect() as connection:
+            connection.execute(f"INSERT OR IGNORE INTO {self.table} (media_id, start_byte, end_byte) VALUES (?, ?, ?)", [media_id, start, end])
+
+        with self._lock:
+            self._get_index(media_id).add(start, end)
+
+    def read(self, media_id: Union[str, int], start: int, end: int) -> bytes:
+        if end < start:
+            return b""
+
+        file = self.open(media_id)
+        if not file:
+            return b""
+
+        with file:
+            file.seek(start)
+            return file.read(end - start + 1)
+
+    def open(self, media_id: Union[str, int]) -> Optional[BinaryIO]:
+        # Opened under the lock, so the file can't be promoted between resolving its path and opening it
+        with self._lock:
+            try:
+                return open(self.file_path(media_id), "rb")
+            except FileNotFoundError:
+                return None
+
+    def register(self, media_id: Union[str, int], path: Union[str, Path], size: int) -> None:
+        # Serves the media from an already complete file, e.g. one promoted before restart
+        with self._lock:
+            self._files[str(media_id)] = Path(path)
+            self._index[str(media_id)] = IntervalSet([(0, size - 1)])
+
+    def promote(self, media_id: Union[str, int], path: Union[str, Path], size: int) -> Path:
+        # Sparse file already holds the media contiguously, so once it's fully covered it only has to be moved
+        path = Path(path)
+
+        with self._lock:
+            if not self._get_index(media_id).covers(0, size - 1):
+                raise ValueError(f"Media {media_id} is not fully downloaded!")
+
+            os.makedirs(path.parent, exist_ok=True)
+            shutil.move(self.path / f"{media_id}.part", path)
+
+            if os.path.getsize(path) != size:
+                shutil.move(path, self.path / f"{media_id}.part")
+                raise ValueError(f"Media {media_id} has {os.path.getsize(self.path / f'{media_id}.part')} bytes instead of {size}!")
+
+            self._files[str(media_id)] = path
+            self._index[str(media_id)] = IntervalSet([(0, size - 1)])
+
+        self.database.delete(self.table, "media_id = ?", [media_id])
+        return path
+
+    def ranges(self, media_id: Union[str, int], start: int = None, end: int = None) -> List[Tuple[int, int]]:
+        # Stored ranges come merged, so touching chunks are returned as one range
+        with self._lock:
+            if start is None or end is None:
+                return list(self._get_index(media_id))
+
+            return self._get_index(media_id).overlapping(start, end)
+
+    def covered(self, media_id: Union[str, int], start: int, end: int) -> bool:
+        with self._lock:
+            return self._get_index(media_id).covers(start, end)
+
+    def gaps(self, media_id: Union[str, int], start: int, end: int) -> List[Tuple[int, int]]:
+        with self._lock:
+            return self._get_index(media_id).gaps(start, end)
+
+    def stale(self, media_id: Union[str, int]) -> bool:
+        # Ranges are known but the .part file is gone, i.e. another worker process promoted or purged the media
+        with self._lock:
+            return bool(self._index.get(str(media_id))) and not self.is_complete(media_id) and not (self.path / f"{media_id}.part").exists()
+
+    def forget(self, media_id: Union[str, int]) -> None:
+        # Index of the media is loaded from the database again on its next use
+        with self._lock:
+            if str(media_id) not in self._files:
+                self._index.pop(str(media_id), None)
+
+    def _get_index(self, media_id: Union[str, int]) -> IntervalSet:
+        # Loaded from the database once per media, afterwards kept up to date by write and purge (and dropped by forget)
+        if str(media_id) not in self._index:
+            self._index[str(media_id)] = IntervalSet(self.database.select(self.table, ["start_byte", "end_byte"], "media_id = ?", [media_id]))
+
+        return self._index[str(media_id)]
+
+    def purge(self, media_id: Union[str, int]) -> None:
+        self.database.delete(self.table, "media_id = ?", [media_id])
+
+        with self._lock:
+            if str(media_id) not in self._files:
+                self._index.pop(str(media_id), None)
+
+            try:
+                os.remove(self.path / f"{media_id}.part")
+            except FileNotFoundError:
+                pass
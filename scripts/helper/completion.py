@@ -0,0 +1,156 @@
+import asyncio, threading
+from typing import Dict, List, Tuple, Union
+from scripts.helper.intervals import IntervalSet
+
+class RangeWaiter:
+    def __init__(self, media_id: Union[str, int], start: int, end: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.media_id: str = str(media_id)
+        self.start: int = start
+        self.end: int = end
+        self.loop: asyncio.AbstractEventLoop = loop
+        self.future: asyncio.Future = loop.create_future()
+
+        self._buffer: bytearray = bytearray(end - start + 1)
+        self._missing: List[Tuple[int, int]] = [(start, end)] # Sorted
+        self._progress: asyncio.Event = asyncio.Event()
+
+    def done(self) -> bool:
+        return not self._missing
+
+    def filled_until(self) -> int:
+        # First byte not filled yet, everything from start up to it can be handed over already
+        missing = self._missing
+        return missing[0][0] if missing else self.end + 1
+
+    def view(self, start: int, end: int) -> bytes:
+        return bytes(self._buffer[start - self.start:end - self.start + 1])
+
+    async def wait_progress(self) -> None:
+        await self._progress.wait()
+        self._progress.clear()
+
+    def notify(self) -> None:
+        self._call(self._progress.set)
+
+    def overlaps(self, start: int, end: int) -> bool:
+        return not start > self.end and not end < self.start
+
+    def fill(self, start: int, data: bytes) -> bool:
+        end = start + len(data) - 1
+        view = memoryview(data)
+        missing = []
+
+        for gap_start, gap_end in self._missing:
+            fill_start, fill_end = max(gap_start, start), min(gap_end, end)
+
+            if fill_start > fill_end:
+                missing.append((gap_start, gap_end))
+                continue
+
+            self._buffer[fill_start - self.start:fill_end - self.start + 1] = view[fill_start - start:fill_end - start + 1]
+
+            if gap_start < fill_start:
+                missing.append((gap_start, fill_start - 1))
+
+            if fill_end < gap_end:
+                missing.append((fill_end + 1, gap_end))
+
+        self._missing = missing
+        self.notify()
+        return self.done()
+
+    def truncate(self, size: int) -> bool:
+        # Media ends before the requested range does, so everything past the last byte is dropped
+        if size > self.end:
+            return self.done()
+
+        self.end = max(size - 1, self.start - 1)
+        del self._buffer[self.end - self.start + 1:]
+        self._missing = [(gap_start, min(gap_end, self.end)) for gap_start, gap_end in self._missing if gap_start <= self.end]
+        self.notify()
+        return self.done()
+
+    def resolve(self) -> None:
+        self._call(lambda: self.future.done() or self.future.set_result(bytes(self._buffer)))
+
+    def fail(self, exception: Exception) -> None:
+        self._call(lambda: self.future.done() or self.future.set_exception(exception))
+        self.notify()
+
+    def _call(self, callback) -> None:
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                return callback() # Filled from the waiter's own loop, no need to hop through the loop's queue
+        except RuntimeError:
+            pass
+
+        try:
+            self.loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass # Loop of the waiter is already closed, nobody is waiting anymore
+
+class CompletionRegistry:
+    # Waiters subscribe to exact byte intervals and get the bytes handed over in memory as soon as
+    # the intervals are filled, so waiting for a range never touches the database.
+
+    def __init__(self) -> None:
+        self._waiters: Dict[str, List[RangeWaiter]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def subscribe(self, media_id: Union[str, int], start: int, end: int, loop: asyncio.AbstractEventLoop = None) -> RangeWaiter:
+        waiter = RangeWaiter(media_id, start, end, loop or asyncio.get_running_loop())
+
+        with self._lock:
+            self._waiters.setdefault(waiter.media_id, []).append(waiter)
+
+        return waiter
+
+    def unsubscribe(self, waiter: RangeWaiter) -> None:
+        with self._lock:
+            self._remove(waiter)
+
+    def fill(self, media_id: Union[str, int], start: int, data: bytes, waiter: RangeWaiter = None) -> None:
+        if not data:
+            return
+
+        end = start + len(data) - 1
+        with self._lock:
+            for waiter in ([waiter] if waiter else list(self._waiters.get(str(media_id), []))):
+                if waiter.overlaps(start, end) and not waiter.done() and waiter.fill(start, data):
+                    self._complete(waiter)
+
+    def missing(self, media_id: Union[str, int], start: int, end: int) -> List[Tuple[int, int]]:
+        # Parts of the interval that some waiter still waits for, merged
+        missing = IntervalSet()
+        with self._lock:
+            for waiter in self._waiters.get(str(media_id), []):
+                for gap_start, gap_end in waiter._missing:
+                    if gap_start <= end and gap_end >= start:
+                        missing.add(max(gap_start, start), min(gap_end, end))
+
+        return list(missing)
+
+    def truncate(self, media_id: Union[str, int], size: int) -> None:
+        with self._lock:
+            for waiter in list(self._waiters.get(str(media_id), [])):
+                if not waiter.done() and waiter.truncate(size):
+                    self._complete(waiter)
+
+    def fail(self, media_id: Union[str, int], start: int, end: int, exception: Exception) -> None:
+        with self._lock:
+            for waiter in list(self._waiters.get(str(media_id), [])):
+                if waiter.overlaps(start, end) and not waiter.done():
+                    self._remove(waiter)
+                    waiter.fail(exception)
+
+    def _complete(self, waiter: RangeWaiter) -> None:
+        self._remove(waiter)
+        waiter.resolve()
+
+    def _remove(self, waiter: RangeWaiter) -> None:
+        waiters = self._waiters.get(waiter.media_id, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+
+        if not waiters:
+            self._waiters.pop(waiter.media_id, None)
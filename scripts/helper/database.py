@@ -1,25 +1,228 @@
-import sqlite3, os
-from typing import List, Dict
+import asyncio, sqlite3, os, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Dict, Tuple, Union
+
+class QueryStats:
+    # Timings of one statement, percentiles are taken from the most recent samples
+    def __init__(self, samples: int = 1024) -> None:
+        self.count: int = 0
+        self.total: float = 0
+        self.rows: int = 0
+        self.samples: Deque[float] = deque(maxlen=samples)
+
+    def record(self, elapsed: float, rows: int) -> None:
+        self.count += 1
+        self.total += elapsed
+        self.rows += rows
+        self.samples.append(elapsed)
+
+    def percentile(self, percent: float) -> float:
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))] if samples else 0
+
+    def summary(self) -> Dict[str, Union[int, float]]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "rows": self.rows
+        }
 
 class Database:
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, *, cache_size: int = 64 * 1024 ** 2, mmap_size: int = 256 * 1024 ** 2, busy_timeout: float = 5,
+     cached_statements: int = 256, instrument: bool = False) -> None:
         self.path: str = path
+        self.cache_size: int = cache_size # Bytes of page cache per connection
+        self.mmap_size: int = mmap_size
+        self.busy_timeout: float = busy_timeout
+        self.cached_statements: int = cached_statements # Compiled statements kept by every connection
+        self.instrumented: bool = instrument
+
+        self._statements: Dict[tuple, str] = {} # SQL built by the methods below, so same call reuses the same (already compiled) text
+        self._stats: Dict[str, QueryStats] = {}
+        self._stats_lock: threading.Lock = threading.Lock()
+        self._listeners: Dict[str, List[Callable[[str], None]]] = {}
+
+        self._local: threading.local = threading.local()
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._directory_ready: bool = False
+        self._aio: "AsyncDatabase" = None
 
         self.tables: List[str] = self.get_tables()
         self.columns: Dict[str, List[str]] = {table: self.get_columns(table) for table in self.tables}
 
+    @property
+    def aio(self) -> "AsyncDatabase":
+        # Awaitable counterpart of this database, for use from event loops
+        with self._lock:
+            if not self._aio:
+                self._aio = AsyncDatabase(self)
+
+            return self._aio
+
     def connect(self, makedirs: bool = True) -> sqlite3.Connection:
-        if makedirs:
-            os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        
-        return sqlite3.connect(self.path)
+        # Every thread keeps one long-lived connection. In WAL mode readers don't wait for the writer (and
+        # the other way around), so e.g. the CDN can read while the downloader is writing.
+        connection = getattr(self._local, "connection", None)
+        if connection:
+            return connection
+
+        with self._lock:
+            if makedirs and not self._directory_ready:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._directory_ready = True
+
+            for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                self._connections.pop(thread).close()
+
+            # Used only by the thread that opened it, but closed by whichever thread notices its owner is gone
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False, cached_statements=self.cached_statements)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.execute(f"PRAGMA cache_size = {-(self.cache_size // 1024)}")
+            connection.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+            connection.execute("PRAGMA temp_store = MEMORY")
+
+            self._connections[threading.current_thread()] = connection
+
+        self._local.connection = connection
+        return connection
+
+    def close(self) -> None:
+        if self._aio:
+            self._aio.close()
+            self._aio = None
+
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+
+            self._connections.clear()
+            self._local = threading.local()
     
+    def statement(self, key: tuple, build: Callable[[], str]) -> str:
+        sql = self._statements.get(key)
+        if sql is None:
+            if len(self._statements) >= self.cached_statements * 4:
+                self._statements.clear() # Keys with varying parts (e.g. IN lists) would make it grow forever
+
+            sql = self._statements[key] = build()
+
+        return sql
+
+    def execute(self, connection: sqlite3.Connection, sql: str, values: Union[list, List[list]] = (), *, many: bool = False, fetch: bool = False) -> Union[list, int]:
+        # Returns fetched rows, or number of rows changed when not fetching
+        if not self.instrumented:
+            cursor = connection.executemany(sql, values) if many else connection.execute(sql, values)
+            return cursor.fetchall() if fetch else cursor.rowcount
+
+        start = time.perf_counter()
+        cursor = connection.executemany(sql, values) if many else connection.execute(sql, values)
+        result = cursor.fetchall() if fetch else None
+        elapsed = time.perf_counter() - start
+
+        with self._stats_lock:
+            self._stats.setdefault(sql, QueryStats()).record(elapsed, len(result) if fetch else max(cursor.rowcount, 0))
+
+        return result if fetch else cursor.rowcount
+
+    def add_listener(self, table_name: str, callback: Callable[[str], None]) -> None:
+        # Callback gets the table name after every write to it made through this object (in this process only)
+        with self._lock:
+            self._listeners.setdefault(table_name, []).append(callback)
+
+    def remove_listener(self, table_name: str, callback: Callable[[str], None]) -> None:
+        with self._lock:
+            if callback in self._listeners.get(table_name, []):
+                self._listeners[table_name].remove(callback)
+
+    def changed(self, table_name: str) -> None:
+        for callback in list(self._listeners.get(table_name, [])):
+            callback(table_name)
+
+    def instrument(self, enabled: bool = True) -> None:
+        self.instrumented = enabled
+
+    def query_stats(self) -> List[Dict[str, Union[str, int, float]]]:
+        # Statements ordered by total time spent in them, rows are those returned (or changed by writes)
+        with self._stats_lock:
+            stats = [{"query": sql, **stats.summary()} for sql, stats in self._stats.items()]
+
+        return sorted(stats, key=lambda stats: stats["total"], reverse=True)
+
+    def reset_query_stats(self) -> None:
+        with self._stats_lock:
+            self._stats.clear()
+
+    def query_report(self, limit: int = 20) -> str:
+        lines = [f"{'count':>8} {'total ms':>10} {'p50 ms':>8} {'p99 ms':>8} {'rows':>8}  query"]
+
+        for stats in self.query_stats()[:limit]:
+            lines.append(f"{stats['count']:>8} {stats['total'] * 1000:>10.1f} {stats['p50'] * 1000:>8.2f} {stats['p99'] * 1000:>8.2f} {stats['rows']:>8}  {stats['query']}")
+
+        return "\n".join(lines)
+
     def create_table(self, table_name: str, columns: list, if_not_exists: bool = True) -> None:
         with self.connect() as connection:
             connection.execute(f"CREATE TABLE {'IF NOT EXISTS' if if_not_exists else ''} {table_name} ({', '.join(columns)})")
 
         self.tables = self.get_tables()
 
+    @property
+    def version(self) -> int:
+        with self.connect() as connection:
+            return connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, migrations: List[Tuple[int, Union[List[str], Callable[[sqlite3.Connection], None]]]]) -> int:
+        # Migrations are (version, statements or function taking the connection). Version of the last applied one is kept in
+        # user_version, every newer migration runs in its own transaction together with raising it. Returns the new version.
+        current = self.version
+
+        for version, migration in sorted(migrations, key=lambda migration: migration[0]):
+            if version <= current:
+                continue
+
+            connection = self.connect()
+            try:
+                connection.execute("BEGIN")
+
+                if callable(migration):
+                    migration(connection)
+                else:
+                    for statement in migration:
+                        connection.execute(statement)
+
+                connection.execute(f"PRAGMA user_version = {int(version)}")
+                connection.commit()
+            except:
+                connection.rollback()
+                raise
+
+            current = version
+
+        self.tables = self.get_tables()
+        return current
+
+    def explain(self, query: str, values: list = None) -> List[str]:
+        # Query plan steps, e.g. "SEARCH media USING INDEX ..." or "SCAN media"
+        with self.connect() as connection:
+            return [row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}", values if values is not None else [None] * query.count("?")).fetchall()]
+
+    def full_scans(self, queries: List[str]) -> Dict[str, List[str]]:
+        # Queries whose plan reads a whole table instead of searching an index, with those plan steps
+        scans = {}
+
+        for query in queries:
+            steps = [step for step in self.explain(query) if step.startswith("SCAN") and "USING" not in step and "CONSTANT ROW" not in step]
+            if steps:
+                scans[query] = steps
+
+        return scans
+
     def get_tables(self) -> list:
         with self.connect() as connection:
             return [table[0] for table in connection.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
@@ -29,28 +232,154 @@ class Database:
             return [column[1] for column in connection.execute(f"PRAGMA table_info({table_name})").fetchall()]
     
     def insert(self, table_name: str, columns: list, values: list) -> None:
+        sql = self.statement(("insert", table_name, tuple(columns), len(values)),
+            lambda: f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in range(len(values))])})")
+
+        with self.connect() as connection:
+            self.execute(connection, sql, values)
+
+        self.changed(table_name)
+
+    def insert_many(self, table_name: str, columns: list, rows: List[list]) -> None:
+        # All rows are written in one transaction
+        if not rows:
+            return
+
+        sql = self.statement(("insert", table_name, tuple(columns), len(columns)),
+            lambda: f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in range(len(columns))])})")
+
         with self.connect() as connection:
-            connection.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in range(len(values))])})", values)
+            self.execute(connection, sql, rows, many=True)
+
+        self.changed(table_name)
+
+    def upsert(self, table_name: str, columns: list, rows: List[list], conflict_keys: list, update_columns: list = None) -> None:
+        # Inserts rows, those colliding with an existing row on conflict keys update it instead. By default all columns
+        # except the keys are updated, empty update_columns keeps the existing row as it is.
+        if not rows:
+            return
+
+        if update_columns is None:
+            update_columns = [column for column in columns if column not in conflict_keys]
+
+        def build() -> str:
+            action = f"DO UPDATE SET {', '.join([f'{column} = excluded.{column}' for column in update_columns])}" if update_columns else "DO NOTHING"
+            return f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in range(len(columns))])}) " \
+                f"ON CONFLICT ({', '.join(conflict_keys)}) {action}"
+
+        sql = self.statement(("upsert", table_name, tuple(columns), tuple(conflict_keys), tuple(update_columns)), build)
+
+        with self.connect() as connection:
+            self.execute(connection, sql, rows, many=True)
+
+        self.changed(table_name)
 
     def select(self, table_name: str, columns: list, where: str = None, where_values: list = None) -> list:
+        sql = self.statement(("select", table_name, tuple(columns), where),
+            lambda: f"SELECT {', '.join(columns)} FROM {table_name}" + (f" WHERE {where}" if where else ""))
+
         with self.connect() as connection:
-            if where:
-                return connection.execute(f"SELECT {', '.join(columns)} FROM {table_name} WHERE {where}", where_values).fetchall()
-            
-            return connection.execute(f"SELECT {', '.join(columns)} FROM {table_name}").fetchall()
+            return self.execute(connection, sql, where_values if where else [], fetch=True)
     
+    def query(self, sql: str, values: list = None) -> list:
+        # Raw select, for what the methods above can't express (joins, CTEs, ...)
+        with self.connect() as connection:
+            return self.execute(connection, sql, values or [], fetch=True)
+
     def update(self, table_name: str, columns: list, values: list, where: str = None, where_values: list = None) -> None:
+        sql = self.statement(("update", table_name, tuple(columns), where),
+            lambda: f"UPDATE {table_name} SET {', '.join([f'{column} = ?' for column in columns])}" + (f" WHERE {where}" if where else ""))
+
         with self.connect() as connection:
-            if where:
-                connection.execute(f"UPDATE {table_name} SET {', '.join([f'{column} = ?' for column in columns])} WHERE {where}", values + where_values)
-                return
+            self.execute(connection, sql, values + where_values if where else values)
 
-            connection.execute(f"UPDATE {table_name} SET {', '.join([f'{column} = ?' for column in columns])}", values)
+        self.changed(table_name)
     
-    def delete(self, table_name: str, where: str = None, where_values: list = None) -> None:
+    def update_many(self, table_name: str, columns: list, rows: List[list], where: str, where_rows: List[list]) -> None:
+        # Every row of values is paired with the row of where values at the same index, all in one transaction
+        if not rows:
+            return
+
+        sql = self.statement(("update", table_name, tuple(columns), where),
+            lambda: f"UPDATE {table_name} SET {', '.join([f'{column} = ?' for column in columns])} WHERE {where}")
+
+        with self.connect() as connection:
+            self.execute(connection, sql, [[*values, *where_values] for values, where_values in zip(rows, where_rows)], many=True)
+
+        self.changed(table_name)
+
+    def delete(self, table_name: str, where: str = None, where_values: list = None) -> int:
+        sql = self.statement(("delete", table_name, where), lambda: f"DELETE FROM {table_name}" + (f" WHERE {where}" if where else ""))
+
         with self.connect() as connection:
-            if where:
-                connection.execute(f"DELETE FROM {table_name} WHERE {where}", where_values)
-                return
+            count = self.execute(connection, sql, where_values if where else [])
+
+        self.changed(table_name)
+        return count
+
+class AsyncDatabase:
+    # Runs Database methods off the event loop, with the same signatures. Writes go to a single writer
+    # thread, as SQLite takes one writer at a time anyway, so they queue up here instead of on the file
+    # lock. Reads go to a pool of reader threads, which in WAL mode don't wait for the writer.
+
+    def __init__(self, database: Database, readers: int = 4) -> None:
+        self.database: Database = database
+
+        self._writer: ThreadPoolExecutor = ThreadPoolExecutor(1, thread_name_prefix="database-writer")
+        self._readers: ThreadPoolExecutor = ThreadPoolExecutor(readers, thread_name_prefix="database-reader")
+        self._queued: Dict[str, int] = {"reads": 0, "writes": 0}
+        self._lock: threading.Lock = threading.Lock()
+
+    def queue_depth(self) -> Dict[str, int]:
+        # Calls waiting for a free thread, growing numbers mean the database is the bottleneck
+        with self._lock:
+            return dict(self._queued)
+
+    async def _run(self, kind: str, func: Callable, *args) -> Any:
+        def run():
+            with self._lock:
+                self._queued[kind] -= 1
+
+            return func(*args)
+
+        with self._lock:
+            self._queued[kind] += 1
+
+        return await asyncio.get_running_loop().run_in_executor(self._writer if kind == "writes" else self._readers, run)
+
+    async def create_table(self, table_name: str, columns: list, if_not_exists: bool = True) -> None:
+        return await self._run("writes", self.database.create_table, table_name, columns, if_not_exists)
+
+    async def get_tables(self) -> list:
+        return await self._run("reads", self.database.get_tables)
+
+    async def get_columns(self, table_name: str) -> list:
+        return await self._run("reads", self.database.get_columns, table_name)
+
+    async def insert(self, table_name: str, columns: list, values: list) -> None:
+        return await self._run("writes", self.database.insert, table_name, columns, values)
+
+    async def insert_many(self, table_name: str, columns: list, rows: List[list]) -> None:
+        return await self._run("writes", self.database.insert_many, table_name, columns, rows)
+
+    async def upsert(self, table_name: str, columns: list, rows: List[list], conflict_keys: list, update_columns: list = None) -> None:
+        return await self._run("writes", self.database.upsert, table_name, columns, rows, conflict_keys, update_columns)
+
+    async def select(self, table_name: str, columns: list, where: str = None, where_values: list = None) -> list:
+        return await self._run("reads", self.database.select, table_name, columns, where, where_values)
+
+    async def query(self, sql: str, values: list = None) -> list:
+        return await self._run("reads", self.database.query, sql, values)
+
+    async def update(self, table_name: str, columns: list, values: list, where: str = None, where_values: list = None) -> None:
+        return await self._run("writes", self.database.update, table_name, columns, values, where, where_values)
+
+    async def update_many(self, table_name: str, columns: list, rows: List[list], where: str, where_rows: List[list]) -> None:
+        return await self._run("writes", self.database.update_many, table_name, columns, rows, where, where_rows)
+
+    async def delete(self, table_name: str, where: str = None, where_values: list = None) -> int:
+        return await self._run("writes", self.database.delete, table_name, where, where_values)
 
-            connection.execute(f"DELETE FROM {table_name}")
\ No newline at end of file
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
@@ -1,90 +1,197 @@
-import asyncio, json, threading
-from typing import Union, List, Tuple, Literal, Optional
+import asyncio, json, threading, time, os
+from pathlib import Path
+from typing import Union, List, Tuple, Literal, Optional, Dict, AsyncIterator
 from scripts.helper.database import Database
+from scripts.helper.chunkstore import ChunkStore
+from scripts.helper.completion import CompletionRegistry, RangeWaiter
+from scripts.helper.intervals import IntervalMap
+from scripts.helper.scheduler import DownloadScheduler, DownloadJob
 from scripts.helper.requester import Requester
 from scripts.scrappers import Episode, Movie, Series, Service, OgladajAnime_pl
 from scripts.helper.logger import Fore, Color
 
+class ActiveDownload:
+    # Range being downloaded, how far it got (bytes before position are on disk, not indexed yet) and flags waiting for its end
+    def __init__(self, start: int, end: int) -> None:
+        self.start: int = start
+        self.end: int = end
+        self.position: int = start
+        self.flags: List[Tuple[asyncio.Event, asyncio.AbstractEventLoop]] = []
+
 class Downloader:
-    def __init__(self, database: Union[Database, str], services: List[Service], max_downloaders: int = 20) -> None:
+    def __init__(self, database: Union[Database, str], services: List[Service], max_downloaders: int = 20, *, chunk_path: Union[str, Path] = "media/.partial", media_path: Union[str, Path] = "media") -> None:
         self.database: Database = database if isinstance(database, Database) else Database(database)
         self.services: List[Service] = services
+        self.chunks: ChunkStore = ChunkStore(self.database, chunk_path)
+        self.completions: CompletionRegistry = CompletionRegistry()
+        self.media_path: Path = Path(media_path)
 
         self.max_downloaders: int = max_downloaders
         self.priority_downloaders: int = 5
 
+        self.throughput: float = None # Bytes per second of a single chunk download, exponentially averaged
+        self.throughput_smoothing: float = .3
+        self.stream_chunk_size: int = 256 * 1024 # Size of pieces downloaded ranges are written and handed over in
+
         self._tasks: List[asyncio.Task] = []
         self._task_flag: asyncio.Event = None
         self._downloader_loop: asyncio.AbstractEventLoop = None
-        self._top_priority_queue: List[Tuple[str, int, int, int, Optional[Tuple[asyncio.Event, asyncio.AbstractEventLoop]]]] = []
-        self._buffer_queue: List[Tuple[str, int, int, int, Optional[Tuple[asyncio.Event, asyncio.AbstractEventLoop]]]] = []
-        self._queue: List[Tuple[str, int, int, int, Optional[Tuple[asyncio.Event, asyncio.AbstractEventLoop]]]] = []
-        self._requests_in_progress: List[Tuple[str, int, int, Optional[List[Tuple[asyncio.Event, asyncio.AbstractEventLoop]]]]] = []
+        self._scheduler: DownloadScheduler = DownloadScheduler()
+        self._sizes: Dict[str, int] = {}
+        self._requests_in_progress: Dict[str, IntervalMap] = {} # media_id -> ranges being downloaded, each with its ActiveDownload
+        self._progress_lock: threading.Lock = threading.Lock() # Ranges in progress are read by other threads' request_stream
 
         self._running: bool = False
 
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        return self._downloader_loop
+
+    @staticmethod
+    def in_loop(loop: asyncio.AbstractEventLoop) -> bool:
+        try:
+            return asyncio.get_running_loop() is loop
+        except RuntimeError:
+            return False
+
     def set_flag_in_loop(self, flag: asyncio.Event, loop: asyncio.AbstractEventLoop) -> None:
-        async def setter():
+        # Flag belonging to the current loop (always the case when everything shares one loop) is set right away
+        if self.in_loop(loop):
             flag.set()
+            return
 
-        asyncio.run_coroutine_threadsafe(setter(), loop)
+        loop.call_soon_threadsafe(flag.set)
 
     def set_downloader_flag(self) -> None:
-        async def setter():
-            self._task_flag.set()
+        if not self._downloader_loop:
+            return # Not started yet, queue is checked as soon as it is
 
-        asyncio.run_coroutine_threadsafe(setter(), self._downloader_loop)
+        self.set_flag_in_loop(self._task_flag, self._downloader_loop)
 
-    def start(self) -> None:
+    def start(self, as_thread: bool = True) -> Optional[asyncio.Task]:
         self._running = True # Must be set before starting the thread, otherwise while loop will not run
-        threading.Thread(target=lambda: asyncio.run(self._downloader())).start()
+
+        if as_thread:
+            threading.Thread(target=lambda: asyncio.run(self._downloader())).start()
+            return None
+
+        # Runs as a task of the calling event loop, next to the web and websocket servers using it
+        self._task_flag = asyncio.Event()
+        self._downloader_loop = asyncio.get_running_loop()
+        return self._downloader_loop.create_task(self._downloader())
 
     def stop(self) -> None:
         self._running = False
 
-    def queue_download(self, media_id: str, start: int, end: int, chunk_size: int, priority: Union[Literal["top"], Literal["buffer"], Literal["regular"]] = "regular", *, completed_flag: Tuple[asyncio.Event, asyncio.AbstractEventLoop] = None) -> Tuple[int, int, bytes]:
-        {
-            "top": self._top_priority_queue,
-            "buffer": self._buffer_queue,
-            "regular": self._queue
-        }[priority].append((media_id, start, end, chunk_size, completed_flag))
+    def queue_download(self, media_id: str, start: int, end: int, chunk_size: int, priority: Union[Literal["top"], Literal["buffer"], Literal["regular"]] = "regular", *, completed_flag: Tuple[asyncio.Event, asyncio.AbstractEventLoop] = None, deadline: float = None, owner: str = None) -> DownloadJob:
+        # Deadline is a time.monotonic() timestamp at which the first byte of the range is needed
+        job = self._scheduler.push(media_id, start, end, chunk_size, priority, deadline=deadline, owner=owner, flag=completed_flag)
 
         self.set_downloader_flag()
+        return job
 
-    async def request_instant(self, media_id: str, start: int, end: int, chunk_size: int = (1 * 1024 ** 2)) -> bytes:
-        flag = asyncio.Event()
-        
-        self.queue_download(media_id, start, end, chunk_size, "top", completed_flag=(flag, asyncio.get_event_loop()))
+    def cancel(self, media_id: str, owner: str = None) -> int:
+        # Drops queued (not yet started) downloads of the media, e.g. after its viewer disconnected
+        cancelled = self._scheduler.cancel(media_id, owner)
 
-        await flag.wait()
+        for job in cancelled:
+            if job.flag:
+                self.set_flag_in_loop(job.flag[0], job.flag[1])
 
-        #Check if data is in database before returning, because every chunk causes flag to be set
-        out_data = b""
-        chunks = self.database.select("temporary_media_data", ["start_byte", "end_byte", "data"], "media_id = ? AND (NOT start_byte > ? AND NOT end_byte < ?)", [media_id, end, start])
-        
-        for chunk in chunks:
-            out_data += chunk[2][start + len(out_data) - chunk[0]:end - chunk[0] + 1]
+        return len(cancelled)
+
+    def fill_from_disk(self, media_id: str, start: int, end: int, waiter: RangeWaiter = None) -> None:
+        # Hands over stored ranges and pieces of ranges still downloading, which were handed only to waiters existing at the time
+        for range_start, range_end in self.chunks.ranges(media_id, start, end):
+            self.completions.fill(media_id, max(start, range_start), self.chunks.read(media_id, max(start, range_start), min(end, range_end)), waiter)
+
+        with self._progress_lock:
+            in_progress = self._requests_in_progress.get(str(media_id))
+            downloads = [download for _, _, download in in_progress.overlapping(start, end)] if in_progress else []
+
+        for download in downloads:
+            streamed_start, streamed_end = max(start, download.start), min(end, download.position - 1)
+            if streamed_start <= streamed_end:
+                self.completions.fill(media_id, streamed_start, self.chunks.read(media_id, streamed_start, streamed_end), waiter)
+
+    async def request_instant(self, media_id: str, start: int, end: int, chunk_size: int = (1 * 1024 ** 2), *, owner: str = None) -> bytes:
+        if end < start:
+            return b""
+
+        if self.chunks.stale(media_id):
+            self.refresh(media_id)
 
-        while len(out_data) < end - start + 1:
-            flag.clear()
-            await flag.wait()
+        # Subscribe before looking at stored and downloading ranges, so pieces arriving in between are handed over by the registry
+        waiter = self.completions.subscribe(media_id, start, end)
 
-            out_data = b""
-            chunks = self.database.select("temporary_media_data", ["start_byte", "end_byte", "data"], "media_id = ? AND (NOT start_byte > ? AND NOT end_byte < ?)", [media_id, end, start])
+        self.fill_from_disk(media_id, start, end, waiter)
 
-            for chunk in chunks:
-                out_data += chunk[2][start + len(out_data) - chunk[0]:end - chunk[0] + 1]
+        if not waiter.done():
+            self.queue_download(media_id, start, end, chunk_size, "top", deadline=time.monotonic(), owner=owner)
 
-        return out_data
+        try:
+            return await waiter.future
+        finally:
+            self.completions.unsubscribe(waiter)
+
+    async def request_stream(self, media_id: str, start: int, end: int, chunk_size: int = (1 * 1024 ** 2), *, owner: str = None) -> AsyncIterator[bytes]:
+        # Like request_instant, but bytes are yielded as soon as they continue what was yielded before,
+        # so they can be forwarded while the rest of the range is still downloading
+        if end < start:
+            return
+
+        if self.chunks.stale(media_id):
+            self.refresh(media_id)
+
+        waiter = self.completions.subscribe(media_id, start, end)
+
+        self.fill_from_disk(media_id, start, end, waiter)
+
+        if not waiter.done():
+            self.queue_download(media_id, start, end, chunk_size, "top", deadline=time.monotonic(), owner=owner)
+
+        try:
+            position = start
+            while position <= waiter.end:
+                filled_until = waiter.filled_until()
+
+                if filled_until > position:
+                    yield waiter.view(position, filled_until - 1)
+                    position = filled_until
+                elif waiter.future.done():
+                    waiter.future.result() # Raises if the download failed
+                    break
+                else:
+                    await waiter.wait_progress()
+        finally:
+            self.completions.unsubscribe(waiter)
+
+    def _measure_throughput(self, size: int, elapsed: float) -> None:
+        if not size or elapsed <= 0:
+            return
+
+        if self.throughput is None:
+            self.throughput = size / elapsed
+            return
+
+        self.throughput += self.throughput_smoothing * (size / elapsed - self.throughput)
 
     async def get_content_size(self, media_id: str) -> int:
-        media = self.database.select("media", ["refer_id", "metadata", "media_id"], "id = ?", [media_id])
+        if str(media_id) in self._sizes:
+            return self._sizes[str(media_id)]
+
+        media = self.database.select("media", ["refer_id", "metadata", "media_id", "data_path"], "id = ?", [media_id])
 
         if not media:
             raise ValueError("Media not found!")
 
         if media and media[0][1] and json.loads(media[0][1]).get("size"):
-            return json.loads(media[0][1])["size"]
+            self._sizes[str(media_id)] = json.loads(media[0][1])["size"]
+
+            if media[0][3] and os.path.exists(media[0][3]) and not self.chunks.is_complete(media_id):
+                self.chunks.register(media_id, media[0][3], self._sizes[str(media_id)])
+
+            return self._sizes[str(media_id)]
         
         prefix_to_source = {
             "oa-": OgladajAnime_pl
@@ -101,8 +208,49 @@ class Downloader:
         if not meta:
             return 0
         
+        self._sizes[str(media_id)] = meta["size"]
         return meta["size"]
 
+    def refresh(self, media_id: str) -> bool:
+        # With several worker processes another one may have promoted the media, moving away the .part file
+        # ranges known here were stored in. Those are dropped and the final file is served instead, if there is one.
+        self.chunks.forget(media_id)
+
+        media = self.database.select("media", ["data_path"], "id = ?", [media_id])
+        if not media or not media[0][0] or not os.path.isfile(media[0][0]):
+            return False
+
+        # Anything stored here since is left over, e.g. by a download that was running during the promotion
+        self.chunks.register(media_id, media[0][0], os.path.getsize(media[0][0]))
+        self.chunks.purge(media_id)
+        return True
+
+    def compact(self, media_id: str) -> Optional[Path]:
+        # Once the stored ranges cover whole media, its chunks become the final file and data_path is set
+        size = self._sizes.get(str(media_id))
+        if not size or self.chunks.is_complete(media_id) or not self.chunks.covered(media_id, 0, size - 1):
+            return None
+
+        media = self.database.select("media", ["media_format", "data_path"], "id = ?", [media_id])
+        if not media:
+            return None
+
+        if media[0][1] and os.path.isfile(media[0][1]):
+            # Promoted by another worker process meanwhile, whatever was stored here since is left over
+            self.chunks.register(media_id, media[0][1], size)
+            self.chunks.purge(media_id)
+            return Path(media[0][1])
+
+        try:
+            path = self.chunks.promote(media_id, self.media_path / f"{media_id}.{media[0][0] or 'bin'}", size)
+        except (ValueError, OSError) as e:
+            print(Fore.RED + f"Failed to assemble media {media_id}: {e}" + Color.RESET)
+            return None
+
+        self.database.update("media", ["data_path"], [str(path.absolute())], "id = ?", [media_id])
+        print(Fore.GREEN + f"Media {media_id} fully downloaded to {path}" + Color.RESET)
+        return path
+
     async def _downloader(self) -> None:
         # In order to download a media following need to be fulfilled:
         # 1. Media should exist in the database
@@ -112,162 +260,120 @@ class Downloader:
         # 5. Media entry in the database should not be reffered by any other media (so the media won't duplicate)
         # 6. If media is partially inside temporary table it should be prioritized
 
-        self._task_flag = asyncio.Event()
-        self._downloader_loop = asyncio.get_event_loop()
-
-        def cutout_ranges(original_range: Tuple[int, int], cutouts: List[Tuple[int, int]], start_inclusive: bool = False, end_inclusive: bool = False) -> List[Tuple[int, int]]:
-            out_ranges = [original_range]
-
-            for cutout in cutouts:
-                collider = next((range for range in out_ranges if not cutout[0] > range[1] and not cutout[1] < range[0]), None) 
-                if not collider:
-                    continue
-
-                if cutout[0] <= collider[0] and cutout[1] >= collider[1]:
-                     out_ranges.remove(collider)
-
-                elif collider[0] <= cutout[0] and collider[1] >= cutout[1]:
-                    out_ranges.remove(collider)
-                    if cutout[0] - collider[0] > 0:
-                        out_ranges.append((collider[0] if start_inclusive else collider[0], cutout[0] if end_inclusive else cutout[0] - 1))
-                    
-                    if collider[1] - cutout[1] > 0:
-                        out_ranges.append((cutout[1] if start_inclusive else cutout[1] + 1, collider[1] if end_inclusive else collider[1]))
+        if not self.in_loop(self._downloader_loop):
+            self._task_flag = asyncio.Event()
+            self._downloader_loop = asyncio.get_running_loop()
 
-                elif cutout[0] <= collider[0]:
-                    out_ranges.remove(collider)
-                    if collider[1] - cutout[1] > 0:
-                        out_ranges.append((cutout[1] if start_inclusive else cutout[1] + 1, collider[1] if end_inclusive else collider[1]))
-
-                elif cutout[1] >= collider[1]:
-                    out_ranges.remove(collider)
-                    if cutout[0] - collider[0] > 0:
-                        out_ranges.append((collider[0] if start_inclusive else collider[0], cutout[0] if end_inclusive else cutout[0] - 1))
-
-            out_ranges.sort(key=lambda x: x[0])
-
-            return out_ranges
-        
         downloader_tasks: List[asyncio.Task] = []
 
-        async def download_chunk(media_id: str, start: int, end: int, flag: Tuple[asyncio.Event, asyncio.AbstractEventLoop] = None) -> bytes:
+        async def download_chunk(media_id: str, start: int, end: int, download: ActiveDownload, flag: Tuple[asyncio.Event, asyncio.AbstractEventLoop] = None) -> bytes:
             nonlocal downloader_tasks
 
-            media = self.database.select("media", ["refer_id"], "id = ?", [media_id])
-            referer = self.database.select("content", ["source"], "uid = ?", [media[0][0]])
-
-            service_class = {
-                "ogladajanime": OgladajAnime_pl
-            }[referer[0][0]]
-
-            service = next((service for service in self.services if isinstance(service, service_class)), None)
-            content: Union[Movie, Series, Episode] = service.get_by_uid(media[0][0])
-
-            if not content:
-                return b""
-            
-            data = await content.download(media_id, start, end, Requester.get_requester("cda.main"))
-
-            self.database.insert("temporary_media_data", [
-                "media_id",
-                "start_byte",
-                "end_byte",
-                "data"
-            ], [
-                media_id,
-                start,
-                end,
-                data
-            ])
-
-            rip = next((request for request in self._requests_in_progress if request[0] == media_id and request[1] == start and request[2] == end), None)
-            self._requests_in_progress.remove(rip)
-            downloader_tasks.remove(asyncio.current_task())
-
-            if flag:
-                self.set_flag_in_loop(flag[0], flag[1])
-
-            if rip[3]:
-                for flag in rip[3]:
+            # Pieces go to disk and to the waiters as they arrive, the range is indexed once it's all written.
+            # Waiters subscribing in the meantime read what was streamed so far from disk (see fill_from_disk).
+            # However it ends, waiters get an answer and the range is released, otherwise they'd wait forever.
+            position, failed = start, False
+            try:
+                media = self.database.select("media", ["refer_id", "data_path"], "id = ?", [media_id])
+
+                if media and media[0][1] and self.refresh(media_id):
+                    # Promoted by another worker process, waiters get the range from the final file below
+                    position = min(end + 1, os.path.getsize(media[0][1]))
+                    return b""
+
+                referer = self.database.select("content", ["source"], "uid = ?", [media[0][0]])
+
+                service_class = {
+                    "ogladajanime": OgladajAnime_pl
+                }[referer[0][0]]
+
+                service = next((service for service in self.services if isinstance(service, service_class)), None)
+                content: Union[Movie, Series, Episode] = service.get_by_uid(media[0][0])
+
+                if not content:
+                    raise ValueError("Content not found!")
+
+                download_start = time.monotonic()
+                async for piece in content.stream(media_id, start, end, Requester.get_requester("cda.main"), self.stream_chunk_size):
+                    piece = piece[:end - position + 1]
+                    self.chunks.write(media_id, position, piece, index=False)
+                    position += len(piece)
+                    download.position = position # Before filling, so a waiter subscribing in between gets the piece one way or the other
+                    self.completions.fill(media_id, position - len(piece), piece)
+
+                    if position > end:
+                        break
+
+                self._measure_throughput(position - start, time.monotonic() - download_start)
+            except Exception as e:
+                print(Fore.RED + f"Failed to download {start}-{end} of media {media_id}: {e}" + Color.RESET)
+                self.completions.fail(media_id, start, end, e)
+                failed = True
+            except asyncio.CancelledError:
+                self.completions.fail(media_id, start, end, RuntimeError("Download cancelled"))
+                failed = True
+                raise
+            finally:
+                try:
+                    # Whatever arrived before a failure stays stored, waiters which missed some of it get it from disk
+                    self.chunks.index(media_id, start, position - 1)
+                    for missing_start, missing_end in self.completions.missing(media_id, start, position - 1):
+                        self.completions.fill(media_id, missing_start, self.chunks.read(media_id, missing_start, missing_end))
+
+                    self.compact(media_id)
+
+                    if not failed and position <= end:
+                        # Upstream ended before the requested range, so there is nothing past the last byte
+                        self.completions.truncate(media_id, position)
+                except Exception as e:
+                    print(Fore.RED + f"Failed to store {start}-{position - 1} of media {media_id}: {e}" + Color.RESET)
+                    self.completions.fail(media_id, start, end, e)
+
+                with self._progress_lock:
+                    self._requests_in_progress[str(media_id)].pop(start, end)
+                    if not self._requests_in_progress[str(media_id)]:
+                        del self._requests_in_progress[str(media_id)]
+                downloader_tasks.remove(asyncio.current_task())
+
+                if flag:
                     self.set_flag_in_loop(flag[0], flag[1])
 
-            self.set_downloader_flag()
+                for flag in download.flags:
+                    self.set_flag_in_loop(flag[0], flag[1])
+
+                self.set_downloader_flag()
 
         while self._running:
-            while all([not queue for queue in [self._top_priority_queue, self._buffer_queue, self._queue]]) or \
-             (len(downloader_tasks) >= (self.max_downloaders - self.priority_downloaders) and not self._top_priority_queue) or \
+            while not self._scheduler or \
+             (len(downloader_tasks) >= (self.max_downloaders - self.priority_downloaders) and not self._scheduler.pending("top")) or \
              len(downloader_tasks) >= self.max_downloaders:
                 await self._task_flag.wait()
                 self._task_flag.clear()
 
-            queue_type = "top_priority" if self._top_priority_queue else "buffer" if self._buffer_queue else "regular"
-            media_id, start, end, chunk_size, flag = (self._top_priority_queue if self._top_priority_queue else self._buffer_queue if self._buffer_queue else self._queue)[0]
+            job = self._scheduler.pop()
+            media_id, start, end, flag = job.media_id, job.start, job.end, job.flag
 
-            if end - start > chunk_size:
-                if queue_type == "top_priority":
-                    self._top_priority_queue[0] = (media_id, start + chunk_size, end, chunk_size, flag)
-                elif queue_type == "buffer":
-                    self._buffer_queue[0] = (media_id, start + chunk_size, end, chunk_size, flag)
-                else:
-                    self._queue[0] = (media_id, start + chunk_size, end, chunk_size, flag)
-
-                end = start + chunk_size
-
-            colliding_chunks = self.database.select("temporary_media_data", ["start_byte", "end_byte"], "media_id = ? AND (NOT start_byte > ? AND NOT end_byte < ?)", [media_id, end, start])
-            if colliding_chunks:
-                cutouts = cutout_ranges((start, end), colliding_chunks)
-                if not cutouts:
-                    if queue_type == "top_priority":
-                        del self._top_priority_queue[0]
-                    elif queue_type == "buffer":
-                        del self._buffer_queue[0]
-                    else:
-                        del self._queue[0]
-                    if flag:
+            if self.chunks.stale(media_id):
+                self.refresh(media_id)
+
+            # Only parts that are neither stored nor being downloaded are left to download
+            with self._progress_lock:
+                in_progress = self._requests_in_progress.get(str(media_id))
+                gaps = [gap for stored_gap in self.chunks.gaps(media_id, start, end) for gap in (in_progress.gaps(*stored_gap) if in_progress else [stored_gap])]
+                colliding_requests = in_progress.overlapping(start, end) if in_progress else []
+
+            if gaps != [(start, end)]:
+                for gap in gaps:
+                    self._scheduler.requeue(job.copy(*gap))
+
+                if not gaps:
+                    if flag and colliding_requests:
+                        colliding_requests[-1][2].flags.append(flag)
+                    elif flag:
                         self.set_flag_in_loop(flag[0], flag[1])
-                    continue
-                
-                new_queue_start = [(media_id, cutout[0], cutout[1], chunk_size, flag) for cutout in cutouts]
-                if queue_type == "top_priority":
-                    self._top_priority_queue = new_queue_start + self._top_priority_queue[1:]
-                elif queue_type == "buffer":
-                    self._buffer_queue = new_queue_start + self._buffer_queue[1:]
-                else:
-                    self._queue = new_queue_start + self._queue[1:]              
                 continue
-            
-            colliding_requests = [request for request in self._requests_in_progress if request[0] == media_id and request[1] <= start <= request[2] or request[1] <= end <= request[2]]
-            if colliding_requests:
-                cutouts = cutout_ranges((start, end), [(request[1], request[2]) for request in colliding_requests])
-                if not cutouts:
-                    if queue_type == "top_priority":
-                        del self._top_priority_queue[0]
-                    elif queue_type == "buffer":
-                        del self._buffer_queue[0]
-                    else:
-                        del self._queue[0]
-
-                    last_request = colliding_requests[-1]
-                    if flag:
-                        self._requests_in_progress[self._requests_in_progress.index(last_request)][3].append(flag)
-
-                    continue
-
-                new_queue_start = [(media_id, cutout[0], cutout[1], chunk_size, flag) for cutout in cutouts]
-                if queue_type == "top_priority":
-                    self._top_priority_queue = new_queue_start + self._top_priority_queue[1:]
-                elif queue_type == "buffer":
-                    self._buffer_queue = new_queue_start + self._buffer_queue[1:]
-                else:
-                    self._queue = new_queue_start + self._queue[1:]
-                continue
-
-            self._requests_in_progress.append((media_id, start, end, []))
-            downloader_tasks.append(asyncio.create_task(download_chunk(media_id, start, end, flag)))
 
-            if queue_type == "top_priority":
-                del self._top_priority_queue[0]
-            elif queue_type == "buffer":
-                del self._buffer_queue[0]
-            else:
-                del self._queue[0]
\ No newline at end of file
+            download = ActiveDownload(start, end)
+            with self._progress_lock:
+                self._requests_in_progress.setdefault(str(media_id), IntervalMap()).insert(start, end, download)
+            downloader_tasks.append(asyncio.create_task(download_chunk(media_id, start, end, download, flag)))
\ No newline at end of file
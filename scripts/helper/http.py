@@ -1,5 +1,8 @@
-from flask import Flask
-from typing import List, Union, Callable, Tuple
+import asyncio, contextvars, inspect, socket, sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from flask import Flask, Response
+from typing import List, Union, Callable, Tuple, AsyncIterator, Literal
 
 class Extender:
     def __init__(self) -> None:
@@ -14,6 +17,165 @@ class Extender:
         # Intended to be overridden by derived classes
         return []
 
+class ASGIBridge:
+    # Serves Flask app to an ASGI server. Requests go through Flask's full_dispatch_request in a worker thread,
+    # so hooks, signals and error handlers behave as in threaded mode, but async views (and hooks) are awaited in
+    # the server's event loop instead of a loop created by Flask for every request. Response body may be an async
+    # iterable as well, so streamed responses keep awaiting in the same loop.
+
+    def __init__(self, app: Flask, io_threads: int = 64) -> None:
+        self.app: Flask = app
+        self.loop: asyncio.AbstractEventLoop = None
+        # Sync response bodies (mostly files) get their own threads, so many parallel streams can't starve sync views
+        self._io: ThreadPoolExecutor = ThreadPoolExecutor(io_threads, thread_name_prefix="asgi-io")
+
+        self._ensure_sync: Callable = app.ensure_sync
+        app.ensure_sync = self.ensure_sync
+
+    def ensure_sync(self, func: Callable) -> Callable:
+        # Coroutine function called by Flask from a worker thread is awaited in the server's loop, the thread waits for it.
+        # Its task runs in a copy of the thread's context, so it sees the same request.
+        if not inspect.iscoroutinefunction(func) or not self.loop or not self.loop.is_running() or self.in_loop():
+            return self._ensure_sync(func)
+
+        return lambda *args, **kwargs: asyncio.run_coroutine_threadsafe(func(*args, **kwargs), self.loop).result()
+
+    def in_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            return
+
+        self.loop = asyncio.get_running_loop()
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        # Same as Flask.wsgi_app, only the dispatch is awaited. Threads get the request context as a copy of this task's context.
+        context, error = self.app.request_context(self.environ(scope, bytes(body))), None
+        context.push()
+        try:
+            try:
+                response = await asyncio.to_thread(self.app.full_dispatch_request)
+            except Exception as e:
+                error = e
+                response = await asyncio.to_thread(self.app.handle_exception, e)
+
+            await self.respond(response, scope["method"] == "HEAD", receive, send)
+        finally:
+            if error is not None and self.app.should_ignore_error(error):
+                error = None
+
+            context.pop(error)
+
+    async def respond(self, response: Response, head: bool, receive: Callable, send: Callable) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in response.headers.items()]
+        })
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        chunks = self.iterate(response, self._io)
+        try:
+            if not head:
+                async for chunk in chunks:
+                    if disconnected.is_set():
+                        break
+
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+            await chunks.aclose()
+
+            if hasattr(response.response, "aclose"):
+                await response.response.aclose()
+            else:
+                response.close() # Closes generator of the body, so its cleanup runs
+
+    @staticmethod
+    async def iterate(response: Response, executor: ThreadPoolExecutor = None) -> AsyncIterator[bytes]:
+        body = response.response
+
+        if hasattr(body, "__aiter__"):
+            async for chunk in body:
+                yield bytes(chunk)
+            return
+
+        if isinstance(body, (list, tuple)):
+            yield response.get_data()
+            return
+
+        # Anything else may block on reading files, so it is iterated in a worker thread, in a copy of the request's context
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        iterator = iter(body if response.direct_passthrough else response.iter_encoded())
+        finished = object()
+        while (chunk := await loop.run_in_executor(executor, context.run, next, iterator, finished)) is not finished:
+            yield chunk
+
+    @staticmethod
+    def environ(scope: dict, body: bytes) -> dict:
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }
+
+        for name, value in scope.get("headers", []):
+            name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+            key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        return environ
+
 class WebServer:
     def __init__(self) -> None:
         self._app = Flask(__name__)
@@ -26,4 +188,45 @@ class WebServer:
         self._app.route(route, methods=methods)(func.handler if isinstance(func, Extender) else func)
 
     def run(self, host: str, port: int) -> None:
-        self._app.run(host=host, port=port)
\ No newline at end of file
+        self._app.run(host=host, port=port)
+
+    @staticmethod
+    def bind(host: str, port: int, backlog: int = 2048) -> socket.socket:
+        # Listening socket created once and handed over to every worker process, which then accept from it in turns
+        sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 5000, *, server: Union[Literal["uvicorn"], Literal["hypercorn"]] = "uvicorn",
+     keep_alive: float = 5, sock: socket.socket = None) -> None:
+        # Serves the app from the running event loop, so views share it with everything else running there.
+        # Sock is an already listening socket (see bind), used instead of host and port when given.
+        app = ASGIBridge(self._app)
+
+        if server == "uvicorn":
+            try:
+                import uvicorn
+            except ImportError:
+                raise RuntimeError("Serving with uvicorn requires it to be installed!")
+
+            config = uvicorn.Config(app, host=host, port=port, loop="none", lifespan="off", log_level="warning", timeout_keep_alive=keep_alive)
+            await uvicorn.Server(config).serve(sockets=[sock] if sock else None)
+            return
+
+        if server == "hypercorn":
+            try:
+                from hypercorn.asyncio import serve
+                from hypercorn.config import Config
+            except ImportError:
+                raise RuntimeError("Serving with hypercorn requires it to be installed!")
+
+            config = Config()
+            config.bind = [f"fd://{sock.fileno()}" if sock else f"{host}:{port}"]
+            config.keep_alive_timeout = keep_alive
+            await serve(app, config)
+            return
+
+        raise ValueError(f"Unknown server {server}!")
@@ -0,0 +1,183 @@
+import asyncio, base64, hashlib, json, os, re, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from multidict import CIMultiDict
+
+class CachedResponse:
+    def __init__(self, status: int, headers: Dict[str, str], data: bytes, stored: float, ttl: float, stale: float) -> None:
+        self.status: int = status
+        self.headers: Dict[str, str] = headers
+        self.data: bytes = data
+        self.stored: float = stored # time.time() of the last download or revalidation
+        self.ttl: float = ttl
+        self.stale: float = stale # Seconds after ttl during which it's still served, while being revalidated
+
+    @property
+    def expires(self) -> float:
+        return self.stored + self.ttl
+
+    def fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def usable(self) -> bool:
+        return time.time() < self.expires + self.stale
+
+    def validators(self) -> Dict[str, str]:
+        # Headers making the upstream answer 304 if the response didn't change
+        headers = CIMultiDict(self.headers)
+        return {
+            **({"If-None-Match": headers["ETag"]} if "ETag" in headers else {}),
+            **({"If-Modified-Since": headers["Last-Modified"]} if "Last-Modified" in headers else {})
+        }
+
+    def response(self, binary: bool = False) -> dict:
+        # Same shape as responses returned by Requester
+        response = {
+            "status": self.status,
+            "headers": CIMultiDict(self.headers),
+            "data": self.data
+        }
+
+        try:
+            if not binary:
+                response["text"] = self.data.decode("utf-8")
+        except:
+            pass
+
+        return response
+
+    def dump(self) -> str:
+        return json.dumps({
+            "status": self.status,
+            "headers": self.headers,
+            "data": base64.b64encode(self.data).decode(),
+            "stored": self.stored,
+            "ttl": self.ttl,
+            "stale": self.stale
+        })
+
+    @staticmethod
+    def load(dump: str) -> "CachedResponse":
+        data = json.loads(dump)
+        return CachedResponse(data["status"], data["headers"], base64.b64decode(data["data"]), data["stored"], data["ttl"], data["stale"])
+
+class ResponseCache:
+    # Responses of urls matching one of the rules, kept in memory (least recently used are dropped above
+    # max_entries) and on disk, so they outlive the process. Rules are (url regex, ttl, stale) in seconds,
+    # the first matching one applies. Expired responses are revalidated with ETag / Last-Modified if they had them.
+
+    def __init__(self, path: Union[str, Path] = None, rules: List[Tuple[str, float, float]] = None, *, max_entries: int = 1024) -> None:
+        self.path: Optional[Path] = Path(path) if path else None
+        self.rules: List[Tuple[re.Pattern, float, float]] = [(re.compile(pattern), ttl, stale) for pattern, ttl, stale in rules or []]
+        self.max_entries: int = max_entries
+
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+        self.hits: int = 0
+        self.stale_hits: int = 0
+        self.revalidated: int = 0
+        self.misses: int = 0
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def rule(self, url: str) -> Optional[Tuple[float, float]]:
+        return next(((ttl, stale) for pattern, ttl, stale in self.rules if pattern.search(url)), None)
+
+    @staticmethod
+    def digest(key: tuple) -> str:
+        return hashlib.sha256(json.dumps(key, default=str).encode()).hexdigest()
+
+    async def get(self, key: tuple) -> Optional[CachedResponse]:
+        # Response still usable (fresh or within its stale time), or expired one which can be revalidated
+        digest = self.digest(key)
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry:
+                self._entries.move_to_end(digest)
+
+        if not entry and self.path:
+            entry = await asyncio.to_thread(self._read, digest)
+            if entry:
+                self._remember(digest, entry)
+
+        if entry and not entry.usable() and not entry.validators():
+            self.remove(key)
+            return None
+
+        return entry
+
+    async def put(self, key: tuple, response: dict, ttl: float, stale: float) -> CachedResponse:
+        entry = CachedResponse(response["status"], dict(response["headers"]), response["data"], time.time(), ttl, stale)
+        digest = self.digest(key)
+
+        self._remember(digest, entry)
+        if self.path:
+            await asyncio.to_thread(self._write, digest, entry)
+
+        return entry
+
+    async def refresh(self, key: tuple, entry: CachedResponse) -> None:
+        # Upstream confirmed the response didn't change
+        entry.stored = time.time()
+
+        if self.path:
+            await asyncio.to_thread(self._write, self.digest(key), entry)
+
+    def remove(self, key: tuple) -> None:
+        digest = self.digest(key)
+
+        with self._lock:
+            self._entries.pop(digest, None)
+
+        if self.path and (self.path / digest).exists():
+            (self.path / digest).unlink(missing_ok=True)
+
+    def prune(self) -> int:
+        # Deletes responses from disk which can't be served nor revalidated anymore
+        if not self.path:
+            return 0
+
+        pruned = 0
+        for file in self.path.iterdir():
+            entry = self._read(file.name)
+            if not entry or (not entry.usable() and not entry.validators()):
+                file.unlink(missing_ok=True)
+                pruned += 1
+
+        return pruned
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses
+        }
+
+    def _remember(self, digest: str, entry: CachedResponse) -> None:
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _read(self, digest: str) -> Optional[CachedResponse]:
+        try:
+            with open(self.path / digest, "r") as file:
+                return CachedResponse.load(file.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, digest: str, entry: CachedResponse) -> None:
+        # Written next to the final file and moved over it, so readers never see a half written one
+        temporary = self.path / f".{digest}.{os.getpid()}.{threading.get_ident()}"
+        with open(temporary, "w") as file:
+            file.write(entry.dump())
+
+        os.replace(temporary, self.path / digest)
@@ -0,0 +1,102 @@
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterable, Iterator, List, Tuple
+
+def find_gaps(intervals: Iterable[Tuple[int, int]], start: int, end: int) -> List[Tuple[int, int]]:
+    # Intervals have to be sorted and disjoint, ends are inclusive
+    gaps = []
+    position = start
+
+    for interval_start, interval_end in intervals:
+        if interval_start > position:
+            gaps.append((position, min(interval_start - 1, end)))
+
+        position = max(position, interval_end + 1)
+
+        if position > end:
+            break
+
+    if position <= end:
+        gaps.append((position, end))
+
+    return gaps
+
+class IntervalSet:
+    # Sorted set of merged, disjoint byte ranges (inclusive ends). Lookups are binary searches over the
+    # parallel start/end lists, which stay sorted because the ranges never overlap.
+
+    def __init__(self, intervals: Iterable[Tuple[int, int]] = None) -> None:
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+
+        for start, end in intervals or []:
+            self.add(start, end)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return zip(self._starts, self._ends)
+
+    def add(self, start: int, end: int) -> None:
+        if end < start:
+            return
+
+        # Touching ranges are merged as well, so <0, 9> and <10, 19> become <0, 19>
+        left = bisect_left(self._ends, start - 1)
+        right = bisect_right(self._starts, end + 1)
+
+        if left < right:
+            start = min(start, self._starts[left])
+            end = max(end, self._ends[right - 1])
+
+        self._starts[left:right] = [start]
+        self._ends[left:right] = [end]
+
+    def overlapping(self, start: int, end: int) -> List[Tuple[int, int]]:
+        left = bisect_left(self._ends, start)
+        right = bisect_right(self._starts, end)
+        return list(zip(self._starts[left:right], self._ends[left:right]))
+
+    def covers(self, start: int, end: int) -> bool:
+        index = bisect_right(self._starts, start) - 1
+        return index >= 0 and self._ends[index] >= end
+
+    def gaps(self, start: int, end: int) -> List[Tuple[int, int]]:
+        return find_gaps(self.overlapping(start, end), start, end)
+
+class IntervalMap:
+    # Disjoint byte ranges with a value attached to each of them, used for ranges that are being downloaded.
+
+    def __init__(self) -> None:
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        self._values: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def insert(self, start: int, end: int, value: Any = None) -> None:
+        if self.overlapping(start, end):
+            raise ValueError(f"Range {start}-{end} overlaps already stored range!")
+
+        index = bisect_left(self._starts, start)
+        self._starts.insert(index, start)
+        self._ends.insert(index, end)
+        self._values.insert(index, value)
+
+    def pop(self, start: int, end: int, default: Any = None) -> Any:
+        index = bisect_left(self._starts, start)
+
+        if index >= len(self._starts) or self._starts[index] != start or self._ends[index] != end:
+            return default
+
+        del self._starts[index], self._ends[index]
+        return self._values.pop(index)
+
+    def overlapping(self, start: int, end: int) -> List[Tuple[int, int, Any]]:
+        left = bisect_left(self._ends, start)
+        right = bisect_right(self._starts, end)
+        return list(zip(self._starts[left:right], self._ends[left:right], self._values[left:right]))
+
+    def gaps(self, start: int, end: int) -> List[Tuple[int, int]]:
+        return find_gaps([(interval_start, interval_end) for interval_start, interval_end, _ in self.overlapping(start, end)], start, end)
@@ -0,0 +1,84 @@
+import math, threading, time
+from collections import OrderedDict
+from typing import Dict, Optional, Union
+from scripts.helper.downloader import Downloader
+from scripts.helper.util import generate_id
+
+class PlaybackStream:
+    def __init__(self, media_id: str, position: int) -> None:
+        self.media_id: str = media_id
+        self.position: int = position # First byte the viewer has not asked for yet
+        self.queued_until: int = position - 1 # Last byte already queued as read-ahead
+        self.owner: str = generate_id()
+        self.last_seen: float = time.monotonic()
+
+class ReadAhead:
+    # Follows what every viewer reads, and as long as the reads are sequential keeps the next chunks queued at
+    # "buffer" priority ahead of the playhead. Jump to another offset is a seek, which drops pending read-ahead.
+
+    def __init__(self, downloader: Downloader, chunk_size: int = (1 * 1024 ** 2), *, lookahead: float = 30,
+     min_chunks: int = 2, max_chunks: int = 32, stream_timeout: float = 300) -> None:
+        self.downloader: Downloader = downloader
+        self.chunk_size: int = chunk_size
+        self.lookahead: float = lookahead # Seconds of playback to keep ahead of the playhead
+        self.min_chunks: int = min_chunks
+        self.max_chunks: int = max_chunks
+        self.stream_timeout: float = stream_timeout
+
+        self._streams: "OrderedDict[str, PlaybackStream]" = OrderedDict() # Least recently seen first
+        self._lock: threading.Lock = threading.Lock()
+
+    def window(self, size: int, duration: Optional[int]) -> int:
+        # Number of chunks to keep queued. Lookahead at the media bitrate, scaled up when a single upstream
+        # connection is slower than the playback, because then more chunks have to be downloaded in parallel.
+        if not size or not duration:
+            return self.min_chunks
+
+        bitrate = size / duration
+        chunks = bitrate * self.lookahead / self.chunk_size
+
+        if self.downloader.throughput:
+            chunks *= max(1, bitrate / self.downloader.throughput)
+
+        return max(self.min_chunks, min(self.max_chunks, math.ceil(chunks)))
+
+    def observe(self, stream_id: str, media_id: Union[str, int], start: int, end: int, size: int, duration: Optional[int] = None) -> None:
+        now = time.monotonic()
+        media_id = str(media_id)
+
+        with self._lock:
+            # Streams are kept in order of their last read, so only those actually expired are looked at
+            while self._streams and now - next(iter(self._streams.values())).last_seen > self.stream_timeout:
+                self._drop(self._streams.popitem(last=False)[1])
+
+            stream = self._streams.get(stream_id)
+
+            # Anything but a read continuing close to where the previous one ended is a seek
+            if not stream or stream.media_id != media_id or not stream.position - self.chunk_size <= start <= stream.position + self.chunk_size:
+                if stream:
+                    self._drop(stream)
+
+                stream = self._streams[stream_id] = PlaybackStream(media_id, start)
+
+            stream.position = max(stream.position, end + 1)
+            stream.last_seen = now
+            self._streams.move_to_end(stream_id)
+
+            target = min(size - 1, stream.position + self.window(size, duration) * self.chunk_size - 1)
+            if target <= stream.queued_until or stream.position > target:
+                return
+
+            queue_start = max(stream.queued_until + 1, stream.position)
+            bitrate = size / duration if duration else None
+
+            self.downloader.queue_download(media_id, queue_start, target, self.chunk_size, "buffer",
+                deadline=now + ((queue_start - stream.position) / bitrate if bitrate else 0), owner=stream.owner)
+            stream.queued_until = target
+
+    def stop(self, stream_id: str) -> None:
+        with self._lock:
+            if stream_id in self._streams:
+                self._drop(self._streams.pop(stream_id))
+
+    def _drop(self, stream: PlaybackStream) -> None:
+        self.downloader.cancel(stream.media_id, stream.owner)
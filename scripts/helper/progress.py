@@ -0,0 +1,79 @@
+import asyncio, atexit, threading, time
+from typing import Dict, List, Tuple
+from scripts.helper.database import Database
+from scripts.helper.logger import Fore, Color
+
+class WatchProgressBuffer:
+    # Players report their position every few seconds, only the latest one of every (user, content) is kept
+    # here and written by a background thread in one upsert per interval. Crash loses at most that interval.
+
+    def __init__(self, database: Database, interval: float = 5) -> None:
+        self.database: Database = database
+        self.interval: float = interval
+
+        self._pending: Dict[Tuple[str, str], Tuple[int, int]] = {} # (user_id, content_id) -> (progress, updated_at)
+        self._lock: threading.Lock = threading.Lock()
+        self._flush_lock: threading.Lock = threading.Lock() # Held from take to write, so an older position is never written after a newer one
+        self._stopped: threading.Event = threading.Event()
+        self._thread: threading.Thread = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def update(self, user_id: str, content_id: str, progress: int) -> None:
+        with self._lock:
+            self._pending[(user_id, content_id)] = (progress, int(time.time()))
+
+    def take(self, user_id: str = None) -> List[list]:
+        # Removes pending entries (only those of given user if set) and returns them as watch_progress rows
+        with self._lock:
+            keys = [key for key in self._pending if user_id is None or key[0] == user_id]
+            return [[*key, *self._pending.pop(key)] for key in keys]
+
+    def restore(self, rows: List[list]) -> None:
+        # Puts back rows which failed to write, unless there is a newer position already
+        with self._lock:
+            for user_id, content_id, progress, updated_at in rows:
+                self._pending.setdefault((user_id, content_id), (progress, updated_at))
+
+    def flush(self, user_id: str = None) -> int:
+        with self._flush_lock:
+            rows = self.take(user_id)
+
+            try:
+                self.database.upsert("watch_progress", ["user_id", "content_id", "progress", "updated_at"], rows, ["user_id", "content_id"])
+            except:
+                self.restore(rows)
+                raise
+
+        return len(rows)
+
+    async def aflush(self, user_id: str = None) -> int:
+        # Same as flush, from an event loop, e.g. so reads of a user see positions still waiting here
+        return await asyncio.to_thread(self.flush, user_id)
+
+    def start(self) -> None:
+        if self._thread:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._flusher, name="progress-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        # Stops the flusher and writes whatever is left
+        self._stopped.set()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+
+    def _flusher(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(Fore.RED + f"Failed to write watch progress: {e}" + Color.RESET)
@@ -0,0 +1,165 @@
+import asyncio, threading, time
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+class TokenBucket:
+    # Reservation based token bucket. Every acquire takes its tokens right away, even into debt, and gets back
+    # the time at which they actually become available. Later callers reserve behind the earlier ones, so they
+    # are served in arrival order and each one sleeps exactly as long as needed instead of polling.
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate: float = rate # Tokens per second
+        self.capacity: float = capacity
+
+        self._tokens: float = capacity
+        self._updated: float = time.monotonic()
+        self._lock: threading.Lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        # Returns delay after which reserved tokens may be used
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            return max(0, -self._tokens / self.rate)
+
+    def refund(self, tokens: float = 1) -> None:
+        # Gives back tokens of a reservation that was not used
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+    def wait_time(self, tokens: float = 1) -> float:
+        with self._lock:
+            self._refill()
+            return max(0, (tokens - self._tokens) / self.rate)
+
+class ConcurrencyLimiter:
+    # Semaphore usable from any event loop (and thread). Released slot is handed straight to the longest
+    # waiting task, so waiters are served in FIFO order and only one of them is woken up.
+
+    def __init__(self, limit: int = -1) -> None:
+        self.limit: int = limit # -1 means no limit
+
+        self._active: int = 0
+        self._waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            if self.limit == -1 or (self._active < self.limit and not self._waiters):
+                self._active += 1
+                return
+
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+
+            # Slot was already handed over, if the future got it, it has to be passed on
+            if not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            # After the limit was lowered slots are only given back, until there is fewer of them than the limit
+            if (self.limit == -1 or self._active <= self.limit) and self._hand_over():
+                return # Slot goes to the waiter, active count stays the same
+
+            self._active -= 1
+
+    def resize(self, limit: int) -> None:
+        # Raised limit lets waiters in right away, lowered one takes effect as active requests finish
+        with self._lock:
+            self.limit = limit
+
+            while self._waiters and (limit == -1 or self._active < limit):
+                self._active += 1
+                if not self._hand_over():
+                    self._active -= 1
+
+    def _hand_over(self) -> bool:
+        # Must be called with the lock held
+        while self._waiters:
+            loop, future = self._waiters.popleft()
+
+            def hand_over(future: asyncio.Future = future) -> None:
+                if future.cancelled():
+                    self.release() # Waiter gave up in the meantime
+                else:
+                    future.set_result(None)
+
+            try:
+                loop.call_soon_threadsafe(hand_over)
+                return True
+            except RuntimeError:
+                continue # Loop of the waiter is closed
+
+        return False
+
+    async def __aenter__(self) -> "ConcurrencyLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        self.release()
+
+class RateLimiter:
+    # Token buckets kept separately for every host, plus a concurrency limit shared by all of them.
+    # Limits are (rate per second, burst) pairs, all of them have to allow a request before it goes out.
+
+    def __init__(self, limits: List[Tuple[float, float]] = None, max_concurrent: int = -1) -> None:
+        self.limits: List[Tuple[float, float]] = limits or []
+        self.concurrency: ConcurrencyLimiter = ConcurrencyLimiter(max_concurrent)
+
+        self._buckets: Dict[str, List[TokenBucket]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def buckets(self, host: str = "") -> List[TokenBucket]:
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = [TokenBucket(rate, capacity) for rate, capacity in self.limits]
+
+            return self._buckets[host]
+
+    def wait_time(self, host: str = "") -> float:
+        # Seconds until request to the host would be let through by the rate limits
+        return max([bucket.wait_time() for bucket in self.buckets(host)], default=0)
+
+    async def acquire(self, host: str = "") -> None:
+        buckets = self.buckets(host)
+        delay = max([bucket.reserve() for bucket in buckets], default=0)
+
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+
+            await self.concurrency.acquire()
+        except asyncio.CancelledError:
+            for bucket in buckets:
+                bucket.refund()
+            raise
+
+    def release(self) -> None:
+        self.concurrency.release()
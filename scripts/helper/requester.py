@@ -1,5 +1,11 @@
-import aiohttp, asyncio
+import aiohttp, asyncio, json, threading
+from concurrent.futures import Future
+from typing import AsyncGenerator, AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
 from scripts.helper.util import generate_id
+from scripts.helper.ratelimit import RateLimiter
+from scripts.helper.retry import RetryPolicy, CircuitBreaker, AdaptiveConcurrency, CircuitOpenError
+from scripts.helper.httpcache import ResponseCache, CachedResponse
 
 class Requester:
     requesters = {}
@@ -7,7 +13,9 @@ class Requester:
     def __init__(self, id: str = None, *, default_user_agent: str = None, default_headers: dict = None,
      default_timeout: int = 10, default_retries: int = 3, default_retry_delay: int = 5, backoff_exponent: int = 2,
      default_proxies: dict = None, max_concurrent_requests: int = 100, max_requests_per_second: int = -1,
-     max_requests_per_minute: int = -1):
+     max_requests_per_minute: int = -1, pool_limit: int = 100, pool_limit_per_host: int = 20, keepalive_timeout: float = 30,
+     dns_cache_ttl: int = 300, coalesce: bool = False, cache: ResponseCache = None, max_retry_delay: float = 60,
+     breaker_threshold: int = 5, breaker_cooldown: float = 10, adaptive_concurrency: bool = True, min_concurrent_requests: int = 1):
         if not id:
             id = generate_id(16, "hex", avoid=list(self.requesters.keys()))
 
@@ -28,8 +36,28 @@ class Requester:
         self.max_requests_per_second = max_requests_per_second
         self.max_requests_per_minute = max_requests_per_minute
 
-        self._requests_second = 0
-        self._requests_minute = 0
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.coalesce = coalesce # Identical requests made while one is in flight wait for its response instead of sending their own
+        self.cache = cache # Responses of urls matching its rules are served from it while fresh (or stale but revalidating)
+
+        # Rate limits are kept per host, concurrency limit is shared by all requests of the requester
+        self.limiter = RateLimiter([
+            *([(max_requests_per_second, max_requests_per_second)] if max_requests_per_second != -1 else []),
+            *([(max_requests_per_minute / 60, max_requests_per_minute)] if max_requests_per_minute != -1 else [])
+        ], max_concurrent_requests)
+
+        self.retry_policy = RetryPolicy(default_retries, default_retry_delay, backoff_exponent, max_retry_delay)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._breakers_lock = threading.Lock()
+
+        # Concurrency limit goes down while upstream answers with 429 / 5xx and slowly back up to the maximum while it doesn't
+        self.concurrency = AdaptiveConcurrency(self.limiter.concurrency, min_concurrent_requests, max_concurrent_requests) \
+            if adaptive_concurrency and max_concurrent_requests != -1 else None
 
         self._requests_total = 0
         self._requests_failed = 0
@@ -38,107 +66,390 @@ class Requester:
         self._total_data_sent = 0
         self._total_data_received = 0
 
-        self._current_backoff = 1
         self._current_requests = 0
 
         self._requests_on_hold = 0
 
-        self._resetter_task = None
+        self._sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        self._session_closers: Dict[asyncio.AbstractEventLoop, AsyncGenerator] = {}
+        self._sessions_lock = threading.Lock()
+
+        self._connections_created = 0
+        self._connections_reused = 0
+        self._dns_cache_hits = 0
+        self._dns_cache_misses = 0
+
+        # Futures of concurrent.futures, so requests from other threads' loops can join them too
+        self._in_flight: Dict[tuple, Future] = {}
+        self._in_flight_lock = threading.Lock()
+        self._coalesced_hits = 0
+        self._coalesced_misses = 0
+        self._revalidating: Dict[tuple, asyncio.Task] = {}
 
     @staticmethod
     def get_requester(id: str) -> "Requester":
         return Requester.requesters.get(id)
 
-    async def _reset_counters(self):
-        seconds = 0
+    async def _session(self) -> aiohttp.ClientSession:
+        # Sessions (and their connection pools) are bound to the loop they were created in, so every loop
+        # using the requester gets its own, living as long as the loop does
+        loop = asyncio.get_running_loop()
+
+        with self._sessions_lock:
+            for closed_loop in [session_loop for session_loop in self._sessions if session_loop.is_closed()]:
+                del self._sessions[closed_loop]
+                self._session_closers.pop(closed_loop, None)
+
+            session = self._sessions.get(loop)
+            if session and not session.closed:
+                return session
+
+            session = self._sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_limit, limit_per_host=self.pool_limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=self.dns_cache_ttl),
+                trace_configs=[self._trace_config()]
+            )
+            closer = self._session_closers[loop] = self._session_closer(loop, session)
+
+        await closer.__anext__()
+        return session
+
+    async def _session_closer(self, loop: asyncio.AbstractEventLoop, session: aiohttp.ClientSession) -> AsyncGenerator:
+        # Left suspended until the loop shuts its async generators down (asyncio.run, asgiref and iterate_sync do so
+        # before closing it), so sessions of short-lived loops, e.g. those of Flask's async views, are closed while it still runs
+        try:
+            yield
+        finally:
+            with self._sessions_lock:
+                if self._sessions.get(loop) is session:
+                    del self._sessions[loop]
+                    self._session_closers.pop(loop, None)
+
+            await session.close()
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_connection_create_end(session, context, params):
+            self._connections_created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self._connections_reused += 1
+
+        async def on_dns_cache_hit(session, context, params):
+            self._dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, context, params):
+            self._dns_cache_misses += 1
+
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    async def close(self) -> None:
+        # Sessions of other loops are closed in their own loops, those already closed can't be closed anymore
+        with self._sessions_lock:
+            sessions, self._sessions, self._session_closers = self._sessions, {}, {}
+
+        current_loop = asyncio.get_running_loop()
+        for loop, session in sessions.items():
+            if loop is current_loop:
+                await session.close()
+            elif loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), loop))
+
+    @staticmethod
+    async def close_all() -> None:
+        for requester in list(Requester.requesters.values()):
+            await requester.close()
+
+    def stats(self) -> dict:
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
 
-        while True:
-            await asyncio.sleep(1)
-            seconds += 1
+        return {
+            "requests": {
+                "total": self._requests_total,
+                "failed": self._requests_failed,
+                "retried": self._requests_retried,
+                "current": self._current_requests,
+                "on_hold": self._requests_on_hold,
+                "concurrency_limit": self.limiter.concurrency.limit
+            },
+            "circuits": {host: breaker.state for host, breaker in list(self._breakers.items())},
+            "pool": {
+                "sessions": len(sessions),
+                "limit": self.pool_limit,
+                "limit_per_host": self.pool_limit_per_host,
+                "connections_created": self._connections_created,
+                "connections_reused": self._connections_reused,
+                "dns_cache_hits": self._dns_cache_hits,
+                "dns_cache_misses": self._dns_cache_misses
+            },
+            "coalesced": {
+                "hits": self._coalesced_hits, # Requests answered by a response of an identical one, without going upstream
+                "misses": self._coalesced_misses,
+                "in_flight": len(self._in_flight)
+            },
+            **({"cache": self.cache.stats()} if self.cache else {})
+        }
 
-            if self.max_requests_per_second != -1 and seconds >= 60:
-                self._requests_second = 0
-                seconds = 0
+    def wait_time(self, url: str = "") -> float:
+        # Seconds until request to the url (or its host) would be let through by the rate limits (and circuit breaker)
+        host = urlsplit(url).netloc or url
+        return max(self.limiter.wait_time(host), self.breaker(host).wait_time())
 
-            if self.max_requests_per_minute != -1:
-                self._requests_minute = 0
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
 
-    def _should_hold(self):
-        return (self._current_requests >= self.max_concurrent_requests and self.max_concurrent_requests != -1) or \
-             (self._requests_minute >= self.max_requests_per_minute and self.max_requests_per_minute != -1) or \
-             (self._requests_second >= self.max_requests_per_second and self.max_requests_per_second != -1)
+            return self._breakers[host]
+
+    def _record(self, host: str, status: int = None, error: BaseException = None) -> str:
+        # Feeds outcome of a request to the circuit breaker of its host and to the concurrency limit
+        outcome = self.retry_policy.classify(status, error)
+
+        if outcome == "retry":
+            self.breaker(host).failure()
+        elif error is None:
+            self.breaker(host).success() # Host is fine even if it refused this one request
+
+        if self.concurrency:
+            if self.retry_policy.overloaded(status, error):
+                self.concurrency.overload()
+            elif outcome == "ok":
+                self.concurrency.success()
+
+        return outcome
+
+    @staticmethod
+    def _flight_key(method: str, url: str, headers: Optional[dict], data, kwargs: dict) -> tuple:
+        # Headers are part of the key as well, responses may depend on them (e.g. Range or Referer)
+        return (method.upper(), url, json.dumps(headers or {}, sort_keys=True, default=str), json.dumps(data, sort_keys=True, default=str),
+            json.dumps(kwargs, sort_keys=True, default=str))
 
     async def _request(self, method: str, url: str, *, headers: dict = None, timeout: int = 10, retries: int = None,
-        retry_delay: int = None, backoff_exponent: int = None, proxies: dict = None, data: dict = None, allow_redirects: bool = True, **kwargs) -> aiohttp.ClientResponse:
-            if not self._resetter_task:
-                self._resetter_task = asyncio.create_task(self._reset_counters())
-            
-            if self._should_hold():
-                self._requests_on_hold += 1
+        retry_delay: int = None, backoff_exponent: int = None, proxies: dict = None, data: dict = None, allow_redirects: bool = True,
+        binary: bool = False, coalesce: bool = None, cache: bool = True, **kwargs) -> aiohttp.ClientResponse:
+            # Binary responses (e.g. media) are not decoded into "text"
+            rule = self.cache.rule(url) if self.cache and cache else None
+            if rule:
+                key = self._flight_key(method, url, headers, data, {"allow_redirects": allow_redirects, "binary": binary, **kwargs})
 
-                while self._should_hold():
-                    await asyncio.sleep(.2)
+                async def fetch(entry: Optional[CachedResponse]) -> Optional[dict]:
+                    try:
+                        response = await self._request(method, url, headers={**(headers or {}), **(entry.validators() if entry else {})}, timeout=timeout,
+                            retries=retries, retry_delay=retry_delay, backoff_exponent=backoff_exponent, proxies=proxies, data=data,
+                            allow_redirects=allow_redirects, binary=binary, coalesce=coalesce, cache=False, **kwargs)
+                    except (asyncio.TimeoutError, aiohttp.ClientError, CircuitOpenError):
+                        if entry and entry.usable():
+                            return entry.response(binary)
+                        raise
 
-                self._requests_on_hold -= 1
+                    if response and response["status"] == 304 and entry:
+                        self.cache.revalidated += 1
+                        await self.cache.refresh(key, entry)
+                        return entry.response(binary)
 
-            if not headers:
-                headers = self.default_headers
-            else:
-                headers = {**self.default_headers, **headers}
-    
-            if not timeout:
-                timeout = self.default_timeout
-    
-            if not retries:
+                    if response and response["status"] == 200:
+                        await self.cache.put(key, response, *rule)
+                    elif not response and entry and entry.usable():
+                        return entry.response(binary) # Stale response is better than none while upstream fails
+
+                    return response
+
+                entry = await self.cache.get(key)
+
+                if entry and entry.fresh():
+                    self.cache.hits += 1
+                    return entry.response(binary)
+
+                if entry and entry.usable():
+                    # Served stale right away, fresh one is fetched in the background for the next request
+                    self.cache.stale_hits += 1
+                    if key not in self._revalidating:
+                        def revalidated(task: asyncio.Task) -> None:
+                            self._revalidating.pop(key, None)
+                            if not task.cancelled() and task.exception():
+                                print(f"Failed to revalidate {url}: {task.exception()}")
+
+                        self._revalidating[key] = asyncio.create_task(fetch(entry))
+                        self._revalidating[key].add_done_callback(revalidated)
+                    return entry.response(binary)
+
+                self.cache.misses += 1
+                return await fetch(entry)
+
+            if coalesce if coalesce is not None else self.coalesce:
+                key = self._flight_key(method, url, headers, data, {"allow_redirects": allow_redirects, "binary": binary, **kwargs})
+
+                with self._in_flight_lock:
+                    flight = self._in_flight.get(key)
+                    leader = flight is None
+
+                    if leader:
+                        flight = self._in_flight[key] = Future()
+                        self._coalesced_misses += 1
+                    else:
+                        self._coalesced_hits += 1
+
+                if not leader:
+                    # Shielded, so a follower giving up doesn't cancel the request for everyone else
+                    response = await asyncio.shield(asyncio.wrap_future(flight))
+                    return dict(response) if response else response
+
+                try:
+                    response = await self._request(method, url, headers=headers, timeout=timeout, retries=retries, retry_delay=retry_delay,
+                        backoff_exponent=backoff_exponent, proxies=proxies, data=data, allow_redirects=allow_redirects, binary=binary,
+                        coalesce=False, cache=False, **kwargs)
+                except BaseException as e:
+                    with self._in_flight_lock:
+                        self._in_flight.pop(key, None)
+                    flight.set_exception(e)
+                    raise
+
+                with self._in_flight_lock:
+                    self._in_flight.pop(key, None)
+                flight.set_result(response)
+                return dict(response) if response else response
+
+            headers = {**self.default_headers, **(headers or {})}
+
+            if retries is None:
                 retries = self.default_retries
-    
-            if not retry_delay:
-                retry_delay = self.default_retry_delay
-    
-            if not backoff_exponent:
-                backoff_exponent = self.backoff_exponent
-    
+
             if not proxies:
                 proxies = self.default_proxies
-    
+
             if self.default_user_agent not in headers:
                 headers["User-Agent"] = self.default_user_agent
-    
+
+            if not isinstance(timeout, aiohttp.ClientTimeout):
+                timeout = aiohttp.ClientTimeout(total=timeout or self.default_timeout)
+
+            # Error statuses end up as None, errors of the connection itself are raised once retries run out
+            host = urlsplit(url).netloc
+            breaker = self.breaker(host)
+
+            for attempt in range(retries + 1):
+                if not breaker.allow():
+                    if not attempt:
+                        raise CircuitOpenError(host, breaker.wait_time())
+                    break # Circuit opened by failures of this request, it ends with the last of them
+
+                # Attempt ending without an outcome (cancelled, unexpected error) mustn't leave the circuit half-open
+                self._requests_on_hold += 1
+                try:
+                    await self.limiter.acquire(host)
+                except BaseException:
+                    breaker.abandon()
+                    raise
+                finally:
+                    self._requests_on_hold -= 1
+
+                self._current_requests += 1
+                self._requests_total += 1
+
+                status, error, retry_after, to_return = None, None, None, None
+                try:
+                    async with (await self._session()).request(method, url, headers=headers, timeout=timeout, data=data, allow_redirects=allow_redirects, **kwargs) as response:
+                        status = response.status
+                        retry_after = self.retry_policy.retry_after(response.headers.get("Retry-After"))
+
+                        if status < 400:
+                            to_return = {
+                                "status": status,
+                                "headers": response.headers,
+                                "data": await response.read()
+                            }
+
+                            try:
+                                if not binary:
+                                    to_return["text"] = to_return["data"].decode("utf-8")
+                            except:
+                                pass
+                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    error, to_return = e, None
+                except BaseException:
+                    breaker.abandon()
+                    raise
+                finally:
+                    self._current_requests -= 1
+                    self.limiter.release()
+
+                outcome = self._record(host, None if error else status, error)
+                if outcome == "ok":
+                    return to_return
+
+                self._requests_failed += 1
+                if outcome == "fail" or attempt == retries or (retry_after or 0) > self.retry_policy.max_retry_after:
+                    break
+
+                # Retry waits outside of the concurrency limit, other requests may go out in the meantime
+                self._requests_retried += 1
+                await asyncio.sleep(self.retry_policy.delay(attempt, retry_after, retry_delay, backoff_exponent))
+
+            if error:
+                raise error
+
+            return None
+
+    async def stream(self, url: str, *, method: str = "GET", headers: dict = None, timeout: int = 10, data: dict = None,
+        allow_redirects: bool = True, chunk_size: int = 64 * 1024, **kwargs) -> AsyncIterator[bytes]:
+            # Yields the body as it arrives instead of reading it whole. There are no retries, because the caller
+            # may have consumed part of the body already, error status is raised as aiohttp.ClientResponseError.
+            headers = {**self.default_headers, **(headers or {})}
+
+            if self.default_user_agent not in headers:
+                headers["User-Agent"] = self.default_user_agent
+
+            host = urlsplit(url).netloc
+            breaker = self.breaker(host)
+            if not breaker.allow():
+                raise CircuitOpenError(host, breaker.wait_time())
+
+            if not isinstance(timeout, aiohttp.ClientTimeout):
+                # Body may take long to arrive as a whole, only waiting for connection and for each piece of it is limited
+                timeout = aiohttp.ClientTimeout(sock_connect=timeout or self.default_timeout, sock_read=timeout or self.default_timeout)
+
+            # Stream ending without an outcome (cancelled, closed before the headers) mustn't leave the circuit half-open,
+            # once the outcome is recorded abandon() does nothing
+            self._requests_on_hold += 1
+            try:
+                await self.limiter.acquire(host)
+            except BaseException:
+                breaker.abandon()
+                raise
+            finally:
+                self._requests_on_hold -= 1
+
             self._current_requests += 1
             self._requests_total += 1
-    
-            async with aiohttp.ClientSession() as session:
-                async with session.request(method, url, headers=headers, timeout=timeout, data=data, allow_redirects=allow_redirects, **kwargs) as response:
-                    self._current_requests -= 1
-    
+
+            try:
+                async with (await self._session()).request(method, url, headers=headers, timeout=timeout, data=data,
+                 allow_redirects=allow_redirects, **kwargs) as response:
+                    self._record(host, response.status)
                     if response.status >= 400:
                         self._requests_failed += 1
-                        if retries == 0:
-                            return None
-                        
-                        self._requests_retried += 1
-                        await asyncio.sleep(retry_delay)
-                        self._current_backoff *= backoff_exponent
-                        return await self._request(method, url, headers=headers, timeout=timeout, retries=retries - 1,
-                            retry_delay=retry_delay * backoff_exponent, backoff_exponent=backoff_exponent, proxies=proxies, data=data,
-                            allow_redirects=allow_redirects, **kwargs)
-
-                    self._requests_second += 1
-                    self._requests_minute += 1
-                    self._current_backoff = 1
-    
-                    to_return = {
-                         "status": response.status,
-                         "headers": response.headers,
-                         "data": await response.read()
-                    }
+                        response.raise_for_status()
 
-                    try:
-                         to_return["text"] = to_return["data"].decode("utf-8")
-                    except:
-                         pass
-                    
-                    return to_return
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        self._total_data_received += len(chunk)
+                        yield chunk
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+                self._requests_failed += 1
+                self._record(host, error=e)
+                raise
+            except BaseException:
+                breaker.abandon()
+                raise
+            finally:
+                self._current_requests -= 1
+                self.limiter.release()
                 
     async def get(self, url: str, *, headers: dict = None, timeout: int = 10, retries: int = None, retry_delay: int = None,
         backoff_exponent: int = None, proxies: dict = None, params: dict = None, allow_redirects: bool = True, ssl: bool = True,
@@ -0,0 +1,154 @@
+import aiohttp, asyncio, random, threading, time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Literal, Optional, Union
+from scripts.helper.ratelimit import ConcurrencyLimiter
+
+class CircuitOpenError(Exception):
+    def __init__(self, host: str, wait: float) -> None:
+        super().__init__(f"Too many failures of {host}, requests are held back for {wait:.1f}s")
+        self.host: str = host
+        self.wait: float = wait
+
+class RetryPolicy:
+    # Decides which failures are worth another attempt and how long to wait before it. Waits are "full jitter"
+    # exponential backoff, random between 0 and the exponential delay, so clients failing together don't retry together.
+
+    RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+    OVERLOAD_STATUSES = (429, 503)
+
+    def __init__(self, retries: int = 3, base_delay: float = 1, backoff_exponent: float = 2, max_delay: float = 60, max_retry_after: float = 300) -> None:
+        self.retries: int = retries
+        self.base_delay: float = base_delay
+        self.backoff_exponent: float = backoff_exponent
+        self.max_delay: float = max_delay
+        self.max_retry_after: float = max_retry_after # Longer Retry-After isn't waited for, the request fails instead
+
+    def classify(self, status: int = None, error: BaseException = None) -> Union[Literal["ok"], Literal["retry"], Literal["fail"]]:
+        if error is not None:
+            # Timeouts and dropped connections are transient, anything else (e.g. invalid url) won't get better
+            return "retry" if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)) else "fail"
+
+        if status < 400:
+            return "ok"
+
+        return "retry" if status in self.RETRY_STATUSES or status >= 500 else "fail"
+
+    def overloaded(self, status: int = None, error: BaseException = None) -> bool:
+        # Signs of upstream being pushed too hard, as opposed to failures of a single request
+        return status in self.OVERLOAD_STATUSES or (status or 0) >= 500 or isinstance(error, asyncio.TimeoutError)
+
+    def delay(self, attempt: int, retry_after: float = None, base_delay: float = None, backoff_exponent: float = None) -> float:
+        ceiling = min(self.max_delay, (base_delay if base_delay is not None else self.base_delay) * (backoff_exponent or self.backoff_exponent) ** attempt)
+        return max(random.uniform(0, ceiling), retry_after or 0)
+
+    @staticmethod
+    def retry_after(value: Optional[str]) -> Optional[float]:
+        # Retry-After is either number of seconds or a HTTP date
+        if not value:
+            return None
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+class CircuitBreaker:
+    # After threshold failures in a row requests to the host are refused for cooldown seconds, then a single
+    # probe is let through. Its success closes the circuit, its failure opens it again for twice as long.
+
+    def __init__(self, threshold: int = 5, cooldown: float = 10, max_cooldown: float = 300) -> None:
+        self.threshold: int = threshold
+        self.cooldown: float = cooldown
+        self.max_cooldown: float = max_cooldown
+
+        self.failures: int = 0
+        self.state: Union[Literal["closed"], Literal["open"], Literal["half-open"]] = "closed"
+        self._opened: float = 0
+        self._current_cooldown: float = cooldown
+        self._lock: threading.Lock = threading.Lock()
+
+    def wait_time(self) -> float:
+        with self._lock:
+            if self.state == "open":
+                return max(0, self._opened + self._current_cooldown - time.monotonic())
+
+            return 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+
+            if self.state == "open" and time.monotonic() >= self._opened + self._current_cooldown:
+                self.state = "half-open" # This request is the probe, others wait for its result
+                return True
+
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.state = "closed"
+            self._current_cooldown = self.cooldown
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+            if self.state == "half-open":
+                self._current_cooldown = min(self.max_cooldown, self._current_cooldown * 2)
+            elif self.failures < self.threshold:
+                return
+
+            self.state = "open"
+            self._opened = time.monotonic()
+
+    def abandon(self) -> None:
+        # Probe ended without an outcome (e.g. cancelled), so the circuit is open as before and next request probes again
+        with self._lock:
+            if self.state == "half-open":
+                self.state = "open"
+                self._opened = time.monotonic() - self._current_cooldown
+
+class AdaptiveConcurrency:
+    # AIMD on the limit of concurrent requests. Every limit-worth of successful requests raises it by one, an
+    # overloaded upstream halves it, at most once per cooldown, so one burst of failures counts only once.
+
+    def __init__(self, limiter: ConcurrencyLimiter, minimum: int = 1, maximum: int = None, decrease_factor: float = .5, cooldown: float = 2) -> None:
+        self.limiter: ConcurrencyLimiter = limiter
+        self.minimum: int = minimum
+        self.maximum: int = maximum or limiter.limit
+        self.decrease_factor: float = decrease_factor
+        self.cooldown: float = cooldown
+
+        self._successes: int = 0
+        self._decreased: float = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return self.limiter.limit
+
+    def success(self) -> None:
+        with self._lock:
+            self._successes += 1
+
+            if self._successes >= self.limiter.limit and self.limiter.limit < self.maximum:
+                self._successes = 0
+                self.limiter.resize(self.limiter.limit + 1)
+
+    def overload(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased < self.cooldown:
+                return
+
+            self._decreased = now
+            self._successes = 0
+            self.limiter.resize(max(self.minimum, int(self.limiter.limit * self.decrease_factor)))
@@ -0,0 +1,125 @@
+import asyncio, heapq, itertools, threading
+from typing import Dict, List, Literal, Optional, Tuple, Union
+
+class DownloadJob:
+    def __init__(self, media_id: str, start: int, end: int, chunk_size: int, priority: int, deadline: float, sequence: int,
+     owner: str = None, flag: Tuple[asyncio.Event, asyncio.AbstractEventLoop] = None) -> None:
+        self.media_id: str = media_id
+        self.start: int = start
+        self.end: int = end
+        self.chunk_size: int = chunk_size
+        self.priority: int = priority
+        self.deadline: float = deadline
+        self.sequence: int = sequence
+        self.owner: str = owner
+        self.flag: Optional[Tuple[asyncio.Event, asyncio.AbstractEventLoop]] = flag
+
+    def copy(self, start: int, end: int) -> "DownloadJob":
+        return DownloadJob(self.media_id, start, end, self.chunk_size, self.priority, self.deadline, self.sequence, self.owner, self.flag)
+
+    def key(self) -> Tuple[float, int, int]:
+        return (self.deadline, self.sequence, self.start)
+
+class DownloadScheduler:
+    # Pending downloads, ordered by priority class first. Inside a class media are picked by the deadline of
+    # their most urgent job, media with the same deadline take turns, so one long range can't starve the others.
+    # Each media keeps its own heap of jobs, media heap entries are invalidated lazily through versions.
+
+    PRIORITIES: Dict[str, int] = {
+        "top": 0,
+        "buffer": 1,
+        "regular": 2
+    }
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self._sequence: itertools.count = itertools.count()
+        self._served: itertools.count = itertools.count()
+        self._version: itertools.count = itertools.count()
+
+        self._jobs: List[Dict[str, List[Tuple[Tuple[float, int, int], DownloadJob]]]] = [{} for _ in self.PRIORITIES]
+        self._media: List[List[Tuple[float, int, int, int, str]]] = [[] for _ in self.PRIORITIES]
+        self._versions: Dict[Tuple[int, str], int] = {}
+        self._last_served: Dict[Tuple[int, str], int] = {}
+        self._count: List[int] = [0 for _ in self.PRIORITIES]
+
+    def __len__(self) -> int:
+        return sum(self._count)
+
+    def pending(self, priority: Union[Literal["top"], Literal["buffer"], Literal["regular"]] = None) -> int:
+        return len(self) if priority is None else self._count[self.PRIORITIES[priority]]
+
+    def push(self, media_id: Union[str, int], start: int, end: int, chunk_size: int,
+     priority: Union[Literal["top"], Literal["buffer"], Literal["regular"]] = "regular", *, deadline: float = None,
+     owner: str = None, flag: Tuple[asyncio.Event, asyncio.AbstractEventLoop] = None) -> DownloadJob:
+        with self._lock:
+            job = DownloadJob(str(media_id), start, end, chunk_size, self.PRIORITIES[priority],
+                float("inf") if deadline is None else deadline, next(self._sequence), owner, flag)
+            self._push(job)
+            return job
+
+    def requeue(self, job: DownloadJob) -> None:
+        # Puts back (a part of) a job that was already popped, it keeps its place in the ordering
+        with self._lock:
+            self._push(job)
+
+    def pop(self) -> Optional[DownloadJob]:
+        # Returns the next chunk to download, the rest of its job stays queued
+        with self._lock:
+            for priority, media_heap in enumerate(self._media):
+                while media_heap:
+                    *_, version, media_id = heapq.heappop(media_heap)
+                    if self._versions.get((priority, media_id)) != version:
+                        continue
+
+                    jobs = self._jobs[priority][media_id]
+                    _, job = heapq.heappop(jobs)
+                    self._count[priority] -= 1
+
+                    if job.end - job.start + 1 > job.chunk_size:
+                        remainder = job.copy(job.start + job.chunk_size, job.end)
+                        heapq.heappush(jobs, (remainder.key(), remainder))
+                        self._count[priority] += 1
+                        job = job.copy(job.start, job.start + job.chunk_size - 1)
+
+                    self._last_served[(priority, media_id)] = next(self._served)
+                    self._reindex(priority, media_id)
+                    return job
+
+        return None
+
+    def cancel(self, media_id: Union[str, int], owner: str = None) -> List[DownloadJob]:
+        # Drops pending jobs of the media, only those queued by given owner if it's set
+        cancelled = []
+
+        with self._lock:
+            for priority, media_jobs in enumerate(self._jobs):
+                jobs = media_jobs.get(str(media_id))
+                if not jobs:
+                    continue
+
+                kept = [entry for entry in jobs if owner is not None and entry[1].owner != owner]
+                cancelled.extend(entry[1] for entry in jobs if owner is None or entry[1].owner == owner)
+
+                heapq.heapify(kept)
+                media_jobs[str(media_id)] = kept
+                self._count[priority] -= len(jobs) - len(kept)
+                self._reindex(priority, str(media_id))
+
+        return cancelled
+
+    def _push(self, job: DownloadJob) -> None:
+        heapq.heappush(self._jobs[job.priority].setdefault(job.media_id, []), (job.key(), job))
+        self._count[job.priority] += 1
+        self._reindex(job.priority, job.media_id)
+
+    def _reindex(self, priority: int, media_id: str) -> None:
+        jobs = self._jobs[priority].get(media_id)
+
+        if not jobs:
+            self._jobs[priority].pop(media_id, None)
+            self._versions.pop((priority, media_id), None)
+            return
+
+        self._versions[(priority, media_id)] = version = next(self._version)
+        heapq.heappush(self._media[priority], (jobs[0][1].deadline, self._last_served.get((priority, media_id), -1), jobs[0][1].sequence, version, media_id))
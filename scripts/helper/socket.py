@@ -121,21 +121,22 @@ class WebSocketServer:
         self.socket_server: WSServer = None
 
     def start(self, host: str = "0.0.0.0", port: int = 5555, *, handler: callable, as_thread: bool = True) -> Optional[threading.Thread]:        
-        self.host = host
-        self.port = port
-        
-        async def inner():
-            async with serve(host=self.host, port=self.port, ws_handler=handler) as server:
-                self.socket_server = server
-                await server.wait_closed()
-                print("Server closed!")
-
         if as_thread:
-            thread = threading.Thread(target=asyncio.run, args=(inner(),))
+            thread = threading.Thread(target=asyncio.run, args=(self.serve(host, port, handler=handler),))
             thread.start()
             return thread
         
-        asyncio.run(inner())
+        asyncio.run(self.serve(host, port, handler=handler))
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 5555, *, handler: callable) -> None:
+        # Runs in the calling event loop until the server is closed
+        self.host = host
+        self.port = port
+
+        async with serve(host=self.host, port=self.port, ws_handler=handler) as server:
+            self.socket_server = server
+            await server.wait_closed()
+            print("Server closed!")
 
     @staticmethod
     async def send(socket: WebSocketClientProtocol, data: Union[bytes, str, dict], session: "SocketSession", *, rsa_only: bool = False, unencrypted: bool = False) -> None:
@@ -0,0 +1,76 @@
+import threading, time
+from typing import Union
+from scripts.helper.database import Database
+from scripts.helper.util import TTLCache
+from scripts.helper.logger import Fore, Color
+
+class MediaTokenCache:
+    # Media tokens are checked on every range request of a player, so checked ones are kept in memory until they
+    # expire. Unknown tokens are remembered for a short while too, so repeating them doesn't reach the database.
+    # Expired rows are deleted from media_tokens by a background thread, in batches so writers aren't held up.
+
+    def __init__(self, database: Database, max_size: int = 100000, *, negative_ttl: float = 10, sweep_interval: float = 300, sweep_batch: int = 1000) -> None:
+        self.database: Database = database
+        self.negative_ttl: float = negative_ttl
+        self.sweep_interval: float = sweep_interval
+        self.sweep_batch: int = sweep_batch
+
+        self._cache: TTLCache[tuple, int] = TTLCache(negative_ttl, max_size) # (token, media_id) -> expires, 0 for invalid token
+        self._stopped: threading.Event = threading.Event()
+        self._thread: threading.Thread = None
+
+    def valid(self, token: str, media_id: Union[str, int]) -> bool:
+        now = time.time()
+        expires = self._cache.get((token, str(media_id)))
+
+        if expires is None:
+            row = self.database.select("media_tokens", ["MAX(expires)"], "token = ? AND media_id = ? AND expires > ?", [token, media_id, int(now)])
+            expires = row[0][0] if row and row[0][0] else 0
+            self.remember(token, media_id, expires)
+
+        return expires > now
+
+    def remember(self, token: str, media_id: Union[str, int], expires: int) -> None:
+        # Also used by get_media_token right after issuing a token, so its first use doesn't have to look it up
+        self._cache.set((token, str(media_id)), expires, (expires - time.time()) if expires else self.negative_ttl)
+
+    def sweep(self) -> int:
+        # Deletes expired tokens batch by batch, each batch is a short transaction of its own
+        deleted, now = 0, int(time.time())
+
+        while True:
+            count = self.database.delete("media_tokens", "id IN (SELECT id FROM media_tokens WHERE expires <= ? LIMIT ?)", [now, self.sweep_batch])
+            deleted += count
+
+            if count < self.sweep_batch:
+                break
+
+        self._cache.expire()
+        return deleted
+
+    def start(self) -> None:
+        if self._thread:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sweeper, name="media-token-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _sweeper(self) -> None:
+        while True:
+            try:
+                deleted = self.sweep()
+                if deleted:
+                    print(Fore.CYAN + f"Removed {deleted} expired media tokens" + Color.RESET)
+            except Exception as e:
+                print(Fore.RED + f"Failed to remove expired media tokens: {e}" + Color.RESET)
+
+            if self._stopped.wait(self.sweep_interval):
+                break
@@ -1,7 +1,12 @@
-import random, requests, json
-from typing import Union, Literal, List
+import random, requests, json, asyncio, threading, time
+from collections import OrderedDict
+from typing import Union, Literal, List, AsyncIterator, Iterator, TypeVar, Generic, Optional, Tuple
 from hashlib import sha512 as nonsalt_sha512
 
+T = TypeVar("T")
+K = TypeVar("K")
+V = TypeVar("V")
+
 def generate_id(length: int = 16, type: Union[Literal["int"], Literal["str"], Literal["hex"]] = "str", *, charset: Union[str, List[str]] = None, avoid: List[Union[str, int]] = None) -> Union[str, int]:
     if type == "int":
         new = random.randint(10 ** (length - 1), 10 ** length - 1)
@@ -43,4 +48,75 @@ def normalize(string: str):
     return string.replace(" ", "-").lower()
 
 def deduplicate(data: List[str]) -> List[str]:
-    return list(set(data))
\ No newline at end of file
+    return list(set(data))
+
+def iterate_sync(iterator: AsyncIterator[T]) -> Iterator[T]:
+    # Drives async iterator from synchronous code, with one event loop for the whole iteration instead of one per item
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        if hasattr(iterator, "aclose"):
+            loop.run_until_complete(iterator.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens()) # Lets them clean up with the loop still running, e.g. close their sessions
+        loop.close()
+
+class TTLCache(Generic[K, V]):
+    # Entries expire ttl seconds after being set, least recently used ones are dropped above max_size
+    def __init__(self, ttl: float, max_size: int = 1024) -> None:
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+
+        self._entries: "OrderedDict[K, Tuple[V, float]]" = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key, None) is not None
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return default
+
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: K, value: V, ttl: float = None) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry and entry[1] > time.monotonic() else default
+
+    def expire(self) -> int:
+        # Drops all expired entries at once, normally they are dropped only when accessed
+        with self._lock:
+            now = time.monotonic()
+            expired = [key for key, entry in self._entries.items() if entry[1] <= now]
+
+            for key in expired:
+                del self._entries[key]
+
+            return len(expired)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -1,7 +1,7 @@
 import asyncio, json, bs4, html, re, pathlib
 from bs4 import BeautifulSoup
 from asyncio import Task
-from typing import Optional, List, Tuple, Union, Literal, Self, Dict, Coroutine
+from typing import Optional, List, Tuple, Union, Literal, Self, Dict, Coroutine, AsyncIterator
 from datetime import datetime
 from urllib.parse import quote as urlquote, unquote as urlunquote, urlsplit, urlunsplit
 from scripts.helper.requester import Requester
@@ -526,70 +526,11 @@ class OA_Series(Series):
         self.thumbnail = soup.find("img", attrs={"alt": self.title})["data-srcset"].split(" ")[0]
         self.rating = float(sanitize(soup.find("h4", class_="col-6").text.split("/")[0]))
 
-        self.thumbnail = self.service.store_media(self.thumbnail, self, "thumbnail")
+        self.thumbnail = await self.service.store_media(self.thumbnail, self, "thumbnail")
 
         similars: List[OA_Series, OA_Movie] = []
-        tasks: List[Task] = []
+        similar_types: List[str] = []
         for similar in soup.find("div", id="similar_animes").find_all("div", class_="card-body"):
-            async def scrape(similar: Union[OA_Series, OA_Movie], stype):
-                if scrape_similar:
-                    await similar.scrape(False)
-
-
-                in_db = bool(self.service._database.select("content", ["uid"], "uid = ?", [similar.uid]))
-                if in_db and not scrape_similar:
-                    return
-                
-                content_info = similar.info("JSON")
-
-                if stype not in ["movie", "series"]:
-                    stype = "movie" if len(similar.episodes) < 4 else "series"
-
-                if ((stype == "movie" and not isinstance(similar, OA_Movie)) or (stype == "series" and not isinstance(similar, OA_Series))):
-                    new_content = OA_Movie(
-                        url=similar.url,
-                        uid=similar.uid,
-                        service=self.service,
-                        id=similar.id,
-                        pegi=similar.pegi,
-                        alternate_titles=similar.alternate_titles,
-                        tags=similar.tags,
-                        views=similar.views,
-                        rating=similar.rating,
-                        length=similar.episode_length,
-                        trailer_url=similar.trailer_url,
-                        title=similar.title,
-                        requester=self.requester
-                    )
-
-                    await new_content.scrape(scrape_similar)
-                    similars[similars.index(similar)] = new_content # Silent swap
-                    return new_content
-
-                (self.service._database.update if in_db else
-                self.service._database.insert)("content", [
-                    "uid",
-                    "origin_url",
-                    "searchable",
-                    "source",
-                    "weight",
-                    "type",
-                    "title",
-                    "meta"
-                ], [
-                    similar.uid,
-                    similar.url,
-                    True,
-                    "ogladajanime",
-                    1,
-                    ("series" if isinstance(similar, OA_Series) else "movie"),
-                    similar.title,
-                    json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
-                ], **({
-                    "where": "uid = ?",
-                    "where_values": [similar.uid]
-                } if in_db else {}))
-
             if len(similar.find_all("a")) < 2:
                 continue
 
@@ -605,15 +546,77 @@ class OA_Series(Series):
                 pegi = spegi,
                 service=self.service
             ))
+            similar_types.append(stype)
+
+        # One lookup for all of them instead of one per similar title
+        stored_similars = {row[0] for row in await self.service._database.aio.select("content", ["uid"], f"uid IN ({', '.join(['?' for _ in similars])})",
+            [similar.uid for similar in similars])} if similars else set()
+
+        async def scrape(similar: Union[OA_Series, OA_Movie], stype) -> Optional[list]:
+            # Returns row of the similar title to store, if there's anything to store
+            if scrape_similar:
+                await similar.scrape(False)
+
+            if similar.uid in stored_similars and not scrape_similar:
+                return None
+            
+            content_info = similar.info("JSON")
+
+            if stype not in ["movie", "series"]:
+                stype = "movie" if len(similar.episodes) < 4 else "series"
+
+            if ((stype == "movie" and not isinstance(similar, OA_Movie)) or (stype == "series" and not isinstance(similar, OA_Series))):
+                new_content = OA_Movie(
+                    url=similar.url,
+                    uid=similar.uid,
+                    service=self.service,
+                    id=similar.id,
+                    pegi=similar.pegi,
+                    alternate_titles=similar.alternate_titles,
+                    tags=similar.tags,
+                    views=similar.views,
+                    rating=similar.rating,
+                    length=similar.episode_length,
+                    trailer_url=similar.trailer_url,
+                    title=similar.title,
+                    requester=self.requester
+                )
+
+                await new_content.scrape(scrape_similar)
+                similars[similars.index(similar)] = new_content # Silent swap, new content stores itself
+                return None
+
+            return [
+                similar.uid,
+                similar.url,
+                True,
+                "ogladajanime",
+                1,
+                ("series" if isinstance(similar, OA_Series) else "movie"),
+                similar.title,
+                json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
+            ]
 
-            tasks.append(asyncio.create_task(scrape(similars[-1], stype)))
+        tasks: List[Task] = [asyncio.create_task(scrape(similar, stype)) for similar, stype in zip(list(similars), similar_types)]
 
         if tasks:
             await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
 
+        await self.service._database.aio.upsert("content", [
+            "uid",
+            "origin_url",
+            "searchable",
+            "source",
+            "weight",
+            "type",
+            "title",
+            "meta"
+        ], [task.result() for task in tasks if not task.exception() and task.result()], ["uid"])
+
         self.similar = similars
 
         episodes: List[OA_Episode] = []
+        episode_rows: List[list] = []
         for episode in soup.find("ul", id="ep_list").find_all("li"):
             # TODO: Sometimes, if episodes are not yet released, they are empty. Should be handled.
             # Sometimes OVAs or ONAs are mistaken for series, when in reality they are movies.
@@ -650,21 +653,8 @@ class OA_Series(Series):
                 requester=self.requester
             ))
 
-            in_db = bool(self.service._database.select("content", ["uid"], "uid = ?", [episodes[-1].uid]))
             content_info = episodes[-1].info("JSON")
-            (self.service._database.update if in_db else
-            self.service._database.insert)("content", [
-                "uid",
-                "origin_url",
-                "searchable",
-                "source",
-                "weight",
-                "type",
-                "title",
-                "parent_uid",
-                "self_index",
-                "meta"
-            ], [
+            episode_rows.append([
                 episodes[-1].uid,
                 episodes[-1].url,
                 True,
@@ -675,10 +665,21 @@ class OA_Series(Series):
                 self.uid,
                 int(episodes[-1].index),
                 json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
-            ], **({
-                "where": "uid = ?",
-                "where_values": [episodes[-1].uid]
-            } if in_db else {}))
+            ])
+
+        # All episodes are written in one transaction
+        await self.service._database.aio.upsert("content", [
+            "uid",
+            "origin_url",
+            "searchable",
+            "source",
+            "weight",
+            "type",
+            "title",
+            "parent_uid",
+            "self_index",
+            "meta"
+        ], episode_rows, ["uid"])
 
         self.episodes = episodes
         self.is_scrapped = True
@@ -703,10 +704,8 @@ class OA_Series(Series):
             await new_content.scrape()
             return new_content
 
-        in_db = bool(self.service._database.select("content", ["uid"], "uid = ?", [self.uid]))        
         content_info = self.info("JSON")
-        (self.service._database.update if in_db else
-        self.service._database.insert)("content", [
+        await self.service._database.aio.upsert("content", [
             "uid",
             "origin_url",
             "searchable",
@@ -715,7 +714,7 @@ class OA_Series(Series):
             "type",
             "title",
             "meta"
-        ], [
+        ], [[
             self.uid,
             self.url,
             True,
@@ -724,10 +723,7 @@ class OA_Series(Series):
             "series",
             self.title,
             json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
-        ], **({
-            "where": "uid = ?",
-            "where_values": [self.uid]
-        } if in_db else {}))
+        ]], ["uid"])
 
         return self  
 
@@ -913,7 +909,7 @@ class OA_Episode(Episode):
 
         if update_db:
             for source in self.sources:
-                self.sources[self.sources.index(source)].url = self.series.service.store_media(source.url, self, "episode", media_id=f"{source.id}", lookup_meta={
+                self.sources[self.sources.index(source)].url = await self.series.service.store_media(source.url, self, "episode", media_id=f"{source.id}", lookup_meta={
                     "subber": source.subber,
                     "quality": source.quality,
                     "audio_lang": source.audio_lang,
@@ -921,10 +917,8 @@ class OA_Episode(Episode):
                     "source": source.source,
                 }, uid=source.uid, duration=source.duration)
 
-            in_db = bool(self.series.service._database.select("content", ["uid"], "uid = ?", [self.uid]))
             content_info = self.info("JSON")
-            (self.series.service._database.update if in_db else
-            self.series.service._database.insert)("content", [
+            await self.series.service._database.aio.upsert("content", [
                 "uid",
                 "origin_url",
                 "searchable",
@@ -935,7 +929,7 @@ class OA_Episode(Episode):
                 "parent_uid",
                 "self_index",
                 "meta"
-            ], [
+            ], [[
                 self.uid,
                 self.url,
                 True,
@@ -946,10 +940,7 @@ class OA_Episode(Episode):
                 self.series.uid,
                 int(self.index),
                 json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
-            ], **({
-                "where": "uid = ?",
-                "where_values": [self.uid]
-            } if in_db else {}))
+            ]], ["uid"])
 
         return players
     
@@ -965,7 +956,21 @@ class OA_Episode(Episode):
             "Referer": media[0][0],
             "Range": f"bytes={start}-{end}",
             "Cookie": "cda.player=html5",
-        }))['data']
+        }, binary=True))['data']
+
+    async def stream(self, media_id: str, start: int, end: int, requester: Requester, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        # Same as download, but the range is yielded piece by piece as it arrives
+        media = self.series.service._database.select("media", ["origin_url", "metadata"], "id = ?", [media_id])
+
+        if not media:
+            raise ValueError("Media not found in database!")
+
+        async for chunk in requester.stream(media[0][0], headers={
+            "Referer": media[0][0],
+            "Range": f"bytes={start}-{end}",
+            "Cookie": "cda.player=html5",
+        }, chunk_size=chunk_size):
+            yield chunk
 
     def info(self, type: Literal['printable'] | Literal['JSON'] = "JSON", *args, **kwargs) -> dict:
         if type.lower() == "json":
@@ -1024,10 +1029,10 @@ class OgladajAnime_pl(Service):
             "X-Requested-With": "XMLHttpRequest",
         }
 
-    def store_media(self, url: str, owner: Union[OA_Episode, OA_Movie, OA_Series], media_name: Union[Literal["thumbnail"]], *, media_id: str = None, lookup_meta: Union[str, dict] = None, download_priority: int = 0, uid: str = None, duration: int = None):
-        existing = self._database.select("media", ["id", "origin_url", "refers_to"], "origin_url = ? AND refer_id != ?", [url, owner.uid])
-        existing_exact = self._database.select("media", ["id", "origin_url", "refers_to", "metadata"], "uid = ?", [uid]) or \
-        self._database.select("media", ["id", "origin_url", "refers_to", "metadata"], "origin_url = ? AND refer_id = ?", [url, owner.uid])
+    async def store_media(self, url: str, owner: Union[OA_Episode, OA_Movie, OA_Series], media_name: Union[Literal["thumbnail"]], *, media_id: str = None, lookup_meta: Union[str, dict] = None, download_priority: int = 0, uid: str = None, duration: int = None):
+        existing = await self._database.aio.select("media", ["id", "origin_url", "refers_to"], "origin_url = ? AND refer_id != ?", [url, owner.uid])
+        existing_exact = await self._database.aio.select("media", ["id", "origin_url", "refers_to", "metadata"], "uid = ?", [uid]) or \
+        await self._database.aio.select("media", ["id", "origin_url", "refers_to", "metadata"], "origin_url = ? AND refer_id = ?", [url, owner.uid])
         if media_name == "thumbnail":
             format = (url or "").split("?")[0].split(".")[-1]
             media_id = f"{int(url.split('?')[0].split('/')[-1].split('.')[0].replace('w', ''))}w"
@@ -1053,7 +1058,7 @@ class OgladajAnime_pl(Service):
 
         if existing_exact:
             metadata = json.loads(existing_exact[0][3])
-            self._database.update("media",
+            await self._database.aio.update("media",
             [
                 "uid",
                 "refer_id",
@@ -1085,7 +1090,7 @@ class OgladajAnime_pl(Service):
             ], "uid = ?", [uid])
         elif existing:
             refers_to = existing[0][2] or existing[0][0]
-            self._database.insert("media", [
+            await self._database.aio.insert("media", [
                     "uid",
                     "refer_id",
                     "download_priority",
@@ -1117,7 +1122,7 @@ class OgladajAnime_pl(Service):
             )
             
         else:
-            self._database.insert("media", [
+            await self._database.aio.insert("media", [
                     "uid",
                     "refer_id",
                     "download_priority",
@@ -1233,7 +1238,7 @@ class OgladajAnime_pl(Service):
         return to_return
 
     async def search(self, query: str, scrape: bool = False, force_scrape: bool = False) -> list[Union[OA_Movie, OA_Series]]:
-        def scrape_children(children: bs4.element.Tag) -> Union[OA_Movie, OA_Series]:    
+        async def scrape_children(children: bs4.element.Tag) -> Union[OA_Movie, OA_Series]:    
             media_type = normalize(sanitize(children.find("span", class_="badge").text))
             media_type = "series" if media_type != "movie" else "movie"
             content = (OA_Movie if media_type == "movie" else OA_Series)(
@@ -1249,29 +1254,19 @@ class OgladajAnime_pl(Service):
                 } if normalize(sanitize(children.find("span", class_="badge").text)) != "movie" else {})
             )
 
-            content.thumbnail = self.store_media(sanitize(children.find("img")["data-srcset"].split(" ")[0]), content, "thumbnail", download_priority=1)
+            content.thumbnail = await self.store_media(sanitize(children.find("img")["data-srcset"].split(" ")[0]), content, "thumbnail", download_priority=1)
 
-            if not self._database.select("content", ["uid"], "uid = ?", [content.uid]):
-                content_info = content.info("JSON")
-                self._database.insert("content", [
-                    "uid",
-                    "origin_url",
-                    "searchable",
-                    "source",
-                    "weight",
-                    "type",
-                    "title",
-                    "meta"
-                ], [
-                    content.uid,
-                    content.url,
-                    True,
-                    "ogladajanime",
-                    1,
-                    media_type,
-                    content.title,
-                    json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
-                ])
+            content_info = content.info("JSON")
+            rows.append([
+                content.uid,
+                content.url,
+                True,
+                "ogladajanime",
+                1,
+                media_type,
+                content.title,
+                json.dumps({key:content_info[key] for key in content_info if key not in ["uid", "title", "url"]})
+            ])
 
             return content
         
@@ -1293,10 +1288,23 @@ class OgladajAnime_pl(Service):
 
         results: List[Union[OA_Movie, OA_Series]] = []
 
+        rows: List[list] = []
         for children in soup.find(id="anime_main").find_all("div", recursive=False):           
-           result = scrape_children(children)           
+           result = await scrape_children(children)           
            results.append(result)
 
+        # Titles found for the first time are stored, already known ones are left as they are
+        await self._database.aio.upsert("content", [
+            "uid",
+            "origin_url",
+            "searchable",
+            "source",
+            "weight",
+            "type",
+            "title",
+            "meta"
+        ], rows, ["uid"], update_columns=[])
+
         if scrape:
             await asyncio.gather(*[media.scrape(False) for media in results if not force_scrape and not self._database.select("content", ["uid"], "uid = ?", [media.uid])])
 
@@ -1,17 +1,52 @@
-import json
+import json, weakref
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from scripts.helper.socket import WebSocketServer, SocketSession
 from scripts.helper.cipher import RSACipher
 from scripts.helper.database import Database
-from scripts.helper.util import generate_id, sha512
+from scripts.helper.progress import WatchProgressBuffer
+from scripts.helper.tokens import MediaTokenCache
+from scripts.helper.util import generate_id, sha512, TTLCache
 from scripts.scrappers import OgladajAnime_pl, OA_Movie, OA_Series, Service, Movie, Series, Episode
 from websockets import WebSocketClientProtocol
 from datetime import datetime, timedelta
-from typing import List, Union, Optional
+from typing import Dict, List, Union, Optional
 
-def authorize_user(id: str, token: str, database: Database) -> bool:
-    return bool(database.select("users", ["id"], "id = ? AND token = ?", [id, token]))
+auth_cache: TTLCache[str, str] = TTLCache(300, 10000) # user id -> token checked against the database in the last minutes
+authorized_sessions: Dict[str, "weakref.WeakSet[SocketSession]"] = {} # user id -> sessions authorized as the user
+
+def remember_user(id: str, token: str, session: SocketSession = None) -> None:
+    auth_cache.set(id, token)
+
+    if session:
+        if session.user_id != id and session.user_id in authorized_sessions:
+            authorized_sessions[session.user_id].discard(session)
+
+        session.user_id, session.user_token, session.authorized = id, token, True
+        authorized_sessions.setdefault(id, weakref.WeakSet()).add(session)
+
+def invalidate_user(id: str) -> None:
+    # Has to be called (from the socket server's loop) by whatever changes token of the user or removes the user,
+    # so the old token stops working right away
+    for session in authorized_sessions.pop(id, []):
+        session.authorized = False
+
+    auth_cache.pop(id)
+
+async def authorize_user(id: str, token: str, database: Database, session: SocketSession = None) -> bool:
+    if not id or not token:
+        return False
+
+    # Session authorized with the same credentials before needs no check, until invalidate_user
+    if session and session.authorized and session.user_id == id and session.user_token == token:
+        return True
+
+    if auth_cache.get(id) != token:
+        if not await database.aio.select("users", ["id"], "id = ? AND token = ?", [id, token]):
+            return False
+
+    remember_user(id, token, session)
+    return True
 
 async def send_error(websocket: WebSocketClientProtocol, session: SocketSession, error: str, code: int = 0, action: str = None, additional: dict = None):
     # Codes table:
@@ -71,7 +106,7 @@ async def get_salt(session: SocketSession, websocket: WebSocketClientProtocol, d
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
 
-    user = database.select("users", ["salt"], ("username = ?" if not "@" in username else "email = ?"), [username])
+    user = await database.aio.select("users", ["salt"], ("username = ?" if not "@" in username else "email = ?"), [username])
     if not user:
         await send_error(websocket, session, "User not found.", action=data.get('action'))
         return
@@ -89,13 +124,15 @@ async def get_user_auth(session: SocketSession, websocket: WebSocketClientProtoc
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
 
-    user = database.select("users", ["id", "password", "token"], ("username = ?" if not "@" in data['data']['username'] else "email = ?"), [data['data']['username']])
+    user = await database.aio.select("users", ["id", "password", "token"], ("username = ?" if not "@" in data['data']['username'] else "email = ?"), [data['data']['username']])
     if not user or not user[0][1] == data['data']['password']:
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
 
+    remember_user(user[0][0], user[0][2], session)
+
     await WebSocketServer.send(websocket, {
         "action": "send-user-auth",
         "data": {
@@ -112,8 +149,7 @@ async def login(session: SocketSession, websocket: WebSocketClientProtocol, data
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
 
-    user = database.select("users", ["id"], "id = ? AND token = ?", [user_id, token])
-    if not user:
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
@@ -136,17 +172,17 @@ async def register(session: SocketSession, websocket: WebSocketClientProtocol, d
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
 
-    if database.select("users", ["id"], "username = ? OR email = ?", [username, email]):
+    if await database.aio.select("users", ["id"], "username = ? OR email = ?", [username, email]):
         await send_error(websocket, session, "Username or email already in use.", code=101, action=data.get('action'),
         additional={
             "success": False
         })
         return
 
-    user_id = generate_id(avoid=[x[0] for x in database.select("users", ["id"])])
+    user_id = generate_id(avoid=[x[0] for x in await database.aio.select("users", ["id"])])
     user_token = hex(int(datetime.now().timestamp()))[2:] + sha512(user_id)[:24] + generate_id(length=32, type="hex")
 
-    database.insert("users",
+    await database.aio.insert("users",
     ["id", "email", "username", "displayname", "password", "salt", "token", "settings", "image", "last_login", "created", "confirmed", "deleted", "suspended"],
     [user_id, email, username, displayname, password, salt, user_token, "{}", None, int(datetime.now().timestamp()), int(datetime.now().timestamp()), True, False, False]
     )
@@ -165,7 +201,7 @@ async def get_user_info(session: SocketSession, websocket: WebSocketClientProtoc
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
 
-    user = database.select("users", ["username", "email", "displayname", "created"], "id = ? AND token = ?", [data['data']['id'], data['data']['token']])
+    user = await database.aio.select("users", ["username", "email", "displayname", "created"], "id = ? AND token = ?", [data['data']['id'], data['data']['token']])
 
     if not user:
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
@@ -217,7 +253,7 @@ async def search(session: SocketSession, websocket: WebSocketClientProtocol, dat
     user_id = data['data'].get('user_id', "")
     token = data['data'].get('token', "")
 
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
@@ -244,7 +280,7 @@ async def get_content_info(session: SocketSession, websocket: WebSocketClientPro
     user_id = data['data'].get('user_id', "")
     token = data['data'].get('token', "")
 
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
@@ -261,7 +297,7 @@ async def get_content_info(session: SocketSession, websocket: WebSocketClientPro
             content = await content.scrape()
 
     else:
-        media = database.select("media", ["refer_id"], "uid = ?", [media_uid])
+        media = await database.aio.select("media", ["refer_id"], "uid = ?", [media_uid])
         if not media:
             await send_error(websocket, session, "Media not found.", action=data.get('action'))
             return
@@ -310,13 +346,13 @@ async def get_players_meta(session: SocketSession, websocket: WebSocketClientPro
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
 
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
     
-    content = database.select("content", ["source"], "uid = ?", [uid])
+    content = await database.aio.select("content", ["source"], "uid = ?", [uid])
 
     if not content:
         await send_error(websocket, session, "Content not found.", action=data.get('action'))
@@ -345,7 +381,7 @@ async def get_players_meta(session: SocketSession, websocket: WebSocketClientPro
         "success": True
     }, session)
 
-async def get_player_data(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, services: List[Service], database: Database):
+async def get_player_data(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, services: List[Service], database: Database, media_tokens: MediaTokenCache):
     media_uid = data['data'].get('media_uid')
     scrape = data['data'].get('scrape', False)
     user_id = data['data'].get('user_id', "")
@@ -358,7 +394,7 @@ async def get_player_data(session: SocketSession, websocket: WebSocketClientProt
                 "user_id": user_id,
                 "token": token
             }
-        }, database, return_data=True)
+        }, database, media_tokens, return_data=True)
 
         source_info['media_token'] = {
             "token": media_token['token'],
@@ -373,19 +409,19 @@ async def get_player_data(session: SocketSession, websocket: WebSocketClientProt
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
     
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
     
-    media = database.select("media", ["refer_id"], "uid = ?", [media_uid])
+    media = await database.aio.select("media", ["refer_id"], "uid = ?", [media_uid])
 
     if not media:
         await send_error(websocket, session, "Media not found.", action=data.get('action'))
         return
     
-    content = database.select("content", ["source", "meta"], "uid = ?", [media[0][0]])
+    content = await database.aio.select("content", ["source", "meta"], "uid = ?", [media[0][0]])
 
     if not content:
         await send_error(websocket, session, "Content not found.", action=data.get('action'))
@@ -407,7 +443,7 @@ async def get_player_data(session: SocketSession, websocket: WebSocketClientProt
         "success": True
     }, session)
 
-async def get_media_token(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, database: Database, return_data: bool = False):
+async def get_media_token(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, database: Database, media_tokens: MediaTokenCache, return_data: bool = False):
     media_uid = data['data'].get('media_uid')
     user_id = data['data'].get('user_id', "")
     token = data['data'].get('token', "")
@@ -416,27 +452,30 @@ async def get_media_token(session: SocketSession, websocket: WebSocketClientProt
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
     
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
     
-    media = database.select("media", ["id"], "uid = ?", [media_uid])
+    media = await database.aio.select("media", ["id"], "uid = ?", [media_uid])
     if not media:
         await send_error(websocket, session, "Media not found.", action=data.get('action'))
         return
     
-    ttoken = database.select("media_tokens", ["token", "expires"], "media_id = ? AND user_id = ? AND expires > ?", [media[0][0], user_id, int((datetime.now() + timedelta(minutes=5)).timestamp())])
+    ttoken = await database.aio.select("media_tokens", ["token", "expires"], "media_id = ? AND user_id = ? AND expires > ?", [media[0][0], user_id, int((datetime.now() + timedelta(minutes=5)).timestamp())])
 
     if not ttoken:
         ttoken = generate_id()
         expires = int((datetime.now() + timedelta(seconds=session.media_token_lifetime)).timestamp())
 
-        database.insert("media_tokens", ["media_id", "user_id", "token", "created", "expires"], [media[0][0], user_id, ttoken, int(datetime.now().timestamp()), expires])
+        await database.aio.insert("media_tokens", ["media_id", "user_id", "token", "created", "expires"], [media[0][0], user_id, ttoken, int(datetime.now().timestamp()), expires])
     else:
         ttoken, expires = ttoken[0]
 
+    # Player requests media with the token right after getting it, so its first use doesn't have to look it up
+    media_tokens.remember(ttoken, media[0][0], expires)
+
     if return_data:
         return {
             "token": ttoken,
@@ -461,15 +500,15 @@ async def download_media(session: SocketSession, websocket: WebSocketClientProto
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
     
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
     
-    content = database.select("media", ["refer_id"], "uid = ?", [uid])
+    content = await database.aio.select("media", ["refer_id"], "uid = ?", [uid])
 
-async def update_watch_progress(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, database: Database):
+async def update_watch_progress(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, database: Database, progress_buffer: WatchProgressBuffer):
     content_uid = data['data'].get('content_uid') or data['data'].get('uid')
     user_id = data['data'].get('user_id', "")
     token = data['data'].get('token', "")
@@ -479,93 +518,95 @@ async def update_watch_progress(session: SocketSession, websocket: WebSocketClie
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
     
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
     
-    id = database.select("watch_progress", ["id"], "content_id = ? AND user_id = ?", [content_uid, user_id])
-
-    if id:
-        database.update("watch_progress", ["progress", "updated_at"], [int(progress), int(datetime.now().timestamp())], "id = ?", [id[0][0]])
-    else:
-        database.insert("watch_progress", ["user_id", "content_id", "progress", "updated_at"], [user_id, content_uid, int(progress), int(datetime.now().timestamp())])
+    # Written together with other updates by the buffer's flusher
+    progress_buffer.update(user_id, content_uid, int(progress))
 
     await WebSocketServer.send(websocket, {
         "action": "update-watch-progress",
         "success": True
     }, session)
 
-async def get_watch_progress(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, database: Database):
+async def get_watch_progress(session: SocketSession, websocket: WebSocketClientProtocol, data: dict, database: Database, progress_buffer: WatchProgressBuffer):
     content_uid = data['data'].get('content_uid') or data['data'].get('uid')
     user_id = data['data'].get('user_id', "")
     token = data['data'].get('token', "")
     top_level = data['data'].get('top_level', False)
+    limit = data['data'].get('limit') # Entries are ordered from the most recently watched, limit and offset page through them
+    offset = data['data'].get('offset', 0)
 
-    if not user_id or not token:
+    if not user_id or not token or (limit is not None and (not isinstance(limit, int) or limit < 1)) or not isinstance(offset, int) or offset < 0:
         await send_error(websocket, session, "Invalid data.", action=data.get('action'))
         return
     
-    if not authorize_user(user_id, token, database):
+    if not await authorize_user(user_id, token, database, session):
         await send_error(websocket, session, "Invalid credentials.", code=111, action=data.get('action'), additional={
             "success": False
         })
         return
     
-    if content_uid:
-        progress_data = database.select("watch_progress", ["content_id", "progress", "updated_at"], "user_id = ? AND content_id = ?", [user_id, content_uid])
-    else:
-        progress_data = database.select("watch_progress", ["content_id", "progress", "updated_at"], "user_id = ?", [user_id])
+    # Positions of the user still held in the buffer go to the database first, so they are read as well
+    await progress_buffer.aflush(user_id)
+
+    # Progress with duration of its video in one query, one more fetches ancestry of the whole page
+    progress_data = await database.aio.query(
+        "SELECT content_id, progress, updated_at, "
+            "(SELECT MAX(media_duration) FROM media WHERE refer_id = watch_progress.content_id AND media_type = 'video') "
+        "FROM watch_progress WHERE user_id = ?" + (" AND content_id = ?" if content_uid else "") + " "
+        "ORDER BY updated_at DESC, content_id LIMIT ? OFFSET ?",
+        [user_id, *([content_uid] if content_uid else []), (limit + 1) if limit else -1, offset])
+
+    has_more = bool(limit) and len(progress_data) > limit
+    progress_data = progress_data[:limit] if limit else progress_data
 
     if not progress_data and content_uid:
         await send_error(websocket, session, "Invalid request!", code=112, action=data.get('action'), additional={
             "success": False
         })
 
-    to_return = []
-    for entry in progress_data:
-        total = [*[duration for duration in database.select("media", ["media_duration"], "refer_id = ? AND media_type='video'", [entry[0]]) if duration], None][0]
-        total = total[0] if total and total[0] else "N/A"
-        to_return.append({
-            "uid": entry[0],
-            "progress": entry[1],
-            "total": total,
-            "updated": entry[2]
-        })
+    to_return = [{
+        "uid": entry[0],
+        "progress": entry[1],
+        "total": entry[3] or "N/A",
+        "updated": entry[2]
+    } for entry in progress_data]
 
     if not top_level:
         await WebSocketServer.send(websocket, {
             "action": "get-watch-progress",
             "success": True,
-            "data": to_return
+            "data": to_return,
+            "has_more": has_more
         }, session)
 
-    for index, entry in enumerate(to_return):
-        parent = ((entry['uid'],),)
-        while True:
-            parent = database.select("content", ["parent_uid", "uid", "type", "self_index"], "uid = ?", [parent[0][0]])
-
-            if not parent:
-                break
-
-            if parent[0][1] == entry['uid']:
-                to_return[index] = {
-                    **to_return[index],
-                    "uid": parent[0][1],
-                    "type": parent[0][2],
-                    **({"index": parent[0][3]} if parent[0][3] else {})
-                }
-                continue
-
-            to_return[index][parent[0][2]] = {
-                "uid": parent[0][1],
-                **({"index": parent[0][3]} if parent[0][3] else {})
-            }
-
+    ancestry = await database.aio.query(
+        "WITH RECURSIVE ancestry(origin, uid, parent_uid, type, self_index, depth) AS ("
+            "SELECT uid, uid, parent_uid, type, self_index, 0 FROM content WHERE uid IN (SELECT value FROM json_each(?)) "
+            "UNION ALL "
+            "SELECT ancestry.origin, content.uid, content.parent_uid, content.type, content.self_index, ancestry.depth + 1 "
+            "FROM content JOIN ancestry ON content.uid = ancestry.parent_uid WHERE ancestry.depth < 16" # Depth limit stops cycles
+        ") SELECT origin, uid, type, self_index, depth FROM ancestry ORDER BY origin, depth",
+        [json.dumps([entry['uid'] for entry in to_return])])
+
+    entries = {entry['uid']: entry for entry in to_return}
+    for origin, uid, content_type, self_index, depth in ancestry:
+        if depth == 0:
+            entries[origin].update({"type": content_type, **({"index": self_index} if self_index else {})})
+            continue
+
+        entries[origin][content_type] = {
+            "uid": uid,
+            **({"index": self_index} if self_index else {})
+        }
 
     await WebSocketServer.send(websocket, {
         "action": "get-watch-progress",
         "success": True,
-        "data": to_return
+        "data": to_return,
+        "has_more": has_more
     }, session)
@@ -1,17 +1,27 @@
-import json, asyncio
+import json, mmap, os, re
 from flask import Flask, Response, request, send_from_directory, redirect, stream_with_context
 from scripts.helper.http import Extender
 from scripts.helper.database import Database
 from scripts.helper.downloader import Downloader
-from typing import List, Callable, Tuple, Dict
+from scripts.helper.prefetcher import ReadAhead
+from scripts.helper.tokens import MediaTokenCache
+from scripts.helper.util import generate_id, iterate_sync, TTLCache
+from typing import List, Callable, Tuple, Dict, Optional, Union, BinaryIO
 from urllib.parse import urlparse
 from pathlib import Path
 
 class WebExtender(Extender):
-    def __init__(self, database: Database, downloader: Downloader) -> None:
+    def __init__(self, database: Database, downloader: Downloader, media_tokens: MediaTokenCache = None) -> None:
         self.database: Database = database
         self.downloader: Downloader = downloader
+        self.media_tokens: MediaTokenCache = media_tokens or MediaTokenCache(database)
+
+        # Public media address (content, resource, format, id) -> media it resolves to. Cleared on any change of media
+        # made by this process, other processes' changes are picked up once the entry expires.
+        self._resolved: TTLCache[tuple, Optional[dict]] = TTLCache(300, 10000)
+        self.database.add_listener("media", lambda table: self._resolved.clear())
         self._standard_chunksize: int = 1024 ** 2 # 1MB
+        self.read_ahead: ReadAhead = ReadAhead(downloader, self._standard_chunksize)
         self.register_paths()
 
     def register_paths(self,) -> List[Tuple[str, List[str], Callable]]:
@@ -24,6 +34,7 @@ class WebExtender(Extender):
             ("/<path:path>", ["GET"], self.app),
             ("/cdn/user/<id>/avatar", ["GET"], self.avatar),
             ("/cdn/media/<content_id>/<resource>", ["GET", "HEAD"], self.cdn_media),
+            ("/debug/queries", ["GET"], self.query_stats),
         ]
 
     def script(self, path: str) -> Response:
@@ -52,6 +63,19 @@ class WebExtender(Extender):
 
         return send_from_directory(str(Path("static/web/").absolute()), path)
     
+    def query_stats(self) -> Response:
+        # Only available with query instrumentation enabled, ?format=text gives the same report as printed on shutdown.
+        # Queue depth is the number of async calls waiting for a database thread.
+        if not self.database.instrumented:
+            return "Not found", 404
+
+        queue_depth = self.database.aio.queue_depth()
+
+        if request.args.get("format") == "text":
+            return Response(f"queue depth: {queue_depth['reads']} reads, {queue_depth['writes']} writes\n\n" + self.database.query_report(int(request.args.get("limit", 50))), mimetype="text/plain")
+
+        return Response(json.dumps({"queue_depth": queue_depth, "queries": self.database.query_stats()}), mimetype="application/json")
+
     def avatar(self, id: str) -> Response:
         image_data = self.database.select("users", ["image"], "id = ?", [id])
 
@@ -60,82 +84,154 @@ class WebExtender(Extender):
         
         return Response(image_data[0][0], mimetype="image/png")
     
+    @staticmethod
+    def parse_range(header: Optional[str], size: int) -> Union[Tuple[int, int], None, bool]:
+        # Returns inclusive (start, end), None when whole content is requested and False if range can't be satisfied
+        match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header or "")
+        if not header or not match or not any(match.groups()):
+            return None
+        
+        start, end = match.groups()
+        if not start:
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+        if start >= size or start > end:
+            return False
+
+        return start, end
+
+    def file_response(self, file: BinaryIO, start: int, end: int, headers: dict, mimetype: str, status: int) -> Response:
+        # Range is streamed from a memory map of the file
+        if end < start:
+            file.close()
+            return Response(b"", headers=headers, mimetype=mimetype, status=status)
+
+        def generator():
+            # Slicing the map copies straight from the page cache, without read() buffering in between
+            with file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(start, end + 1, self._standard_chunksize):
+                    yield mapped[offset:min(offset + self._standard_chunksize, end + 1)]
+
+        return Response(generator(), headers=headers, mimetype=mimetype, status=status, direct_passthrough=True)
+
+    def resolve(self, content_id: str, resource: str, format: str = None, media_id: str = None) -> Optional[dict]:
+        # Finds media of the public address and follows its refers_to links to the one holding the data
+        content = self.database.select("media", ["id", "media_type", "media_format", "media_id", "metadata", "origin_url", "data_path", "refers_to", "requires_token", "media_duration"], f"refer_id = ? AND media_name = ? {'AND media_format = ? ' if format else ''}{'AND media_id = ? ' if media_id else ''}", [content_id, resource, *([format] if format else []), *([media_id] if media_id else [])])
+
+        if not content:
+            return None
+
+        # Tokens are issued for the requested media, not for the one it refers to
+        requested_id = content[0][0]
+        media_type, media_format, duration = content[0][1], content[0][2], content[0][9]
+        metadata, origin_url, data_path, refers_to, requires_token = content[0][4:9]
+        final_id, seen = requested_id, {requested_id}
+
+        while refers_to:
+            new_content = self.database.select("media", ["id", "metadata", "origin_url", "data_path", "refers_to", "requires_token"], "id = ?", [refers_to])
+
+            if not new_content or new_content[0][0] in seen:
+                return None
+
+            final_id, metadata, origin_url, data_path, refers_to, requires_token = new_content[0]
+            seen.add(final_id)
+
+        return {
+            "requested_id": requested_id,
+            "id": final_id,
+            "mimetype": f"{media_type}/{media_format if media_format else 'plain'}",
+            "source": json.loads(metadata).get("source"),
+            "origin_url": origin_url,
+            "data_path": data_path,
+            "requires_token": bool(requires_token),
+            "duration": duration
+        }
+
     async def cdn_media(self, content_id: str, resource: str) -> Response:
-        def generator(media_id, start = 0, end = -1):
-            if end == -1:
-                end = asyncio.run(self.downloader.get_content_size(media_id))
+        async def generator(media_id, start, end, size, stream_id = None, duration = None):
+            # Closing the generator means the viewer went away, so downloads queued only for them are dropped
+            owner = generate_id()
+            try:
+                while start <= end:
+                    self.read_ahead.observe(stream_id, media_id, start, min(start + self._standard_chunksize - 1, end), size, duration)
 
-            while True:
-                data = asyncio.run(self.downloader.request_instant(media_id, start, min(start + self._standard_chunksize - 1, end)))
-                if not data:
-                    continue
+                    sent = 0
+                    async for data in self.downloader.request_stream(media_id, start, min(start + self._standard_chunksize - 1, end), owner=owner):
+                        sent += len(data)
+                        yield data
 
-                yield data
+                    if not sent:
+                        break # Requested past the end of the media
 
-                if (start >= end and end != -1) or (end == -1 and not data):
-                    break
-                
-                start += self._standard_chunksize
+                    start += self._standard_chunksize
+            finally:
+                self.downloader.cancel(media_id, owner)
 
-        range_start, range_end = [*[int(x) for x in request.headers.get("Range", None).split("=")[1].split("-") if x], -1][:2] if "Range" in request.headers else [0, -1]
-        format = request.args.get("format", None)
-        media_id = request.args.get("id", None)
         token = request.args.get("token", None)
-        content = self.database.select("media", ["id", "media_type", "media_format", "media_id", "metadata", "origin_url", "data_path", "refers_to", "requires_token"], f"refer_id = ? AND media_name = ? {'AND media_format = ? ' if format else ''}{'AND media_id = ? ' if media_id else ''}", [content_id, resource, *([format] if format else []), *([media_id] if media_id else [])])
+        key = (content_id, resource, request.args.get("format", None), request.args.get("id", None))
 
-        if not content:
+        media = self._resolved.get(key, False)
+        if media is False:
+            media = self.resolve(*key)
+            self._resolved.set(key, media, None if media else 10)
+
+        if not media:
             return "Invalid request", 400
-        
-        while content[0][6]:
-            new_content = self.database.select("media", ["id", "media_type", "media_format", "media_id", "metadata", "origin_url", "data_path", "refers_to", "requires_token"], f"id = ?", [content[0][5]])
-            
-            if not new_content:
-                return "Invalid request", 400
-            
-            content = (
-                new_content[0][0],
-                content[0][1],
-                content[0][2],
-                content[0][3],
-                content[0][4],
-                content[0][5],
-                new_content[0][6],
-                new_content[0][7],
-                new_content[0][8]
-            )
-
-        if content[0][8]:
+
+        if media["requires_token"]:
             if not token:
                 return "Unauthorized", 401
 
-            if not self.database.select("media_tokens", ["id"], "token = ? AND media_id = ?", [token, content[0][0]]):
+            if not self.media_tokens.valid(token, media["requested_id"]):
                 return "Unauthorized", 401
-            
+
+        mimetype = media["mimetype"]
+        data_path = media["data_path"] if media["data_path"] and Path(media["data_path"]).is_file() else None
+
+        if data_path:
+            size = os.path.getsize(data_path)
+        elif not media["source"] == "cda" and request.method != "HEAD":
+            return redirect(media["origin_url"])
+        else:
+            size = await self.downloader.get_content_size(media["id"])
+
+        byte_range = self.parse_range(request.headers.get("Range"), size)
+        if byte_range is False:
+            return Response(b"", status=416, headers={"Content-Range": f"bytes */{size}"})
+
+        start, end = byte_range or (0, size - 1)
+        status = 206 if byte_range else 200
+        headers = {
+            "Accept-Ranges": "bytes",
+            "Content-Length": str(end - start + 1),
+            **({"Content-Range": f"bytes {start}-{end}/{size}"} if byte_range else {})
+        }
+
         if request.method == "HEAD":
-            return Response(
-                b"",
-                status=200,
-                headers={
-                    "Accept-Ranges": "bytes",
-                    "Content-Length": await self.downloader.get_content_size(content[0][0]),
-                    "Content-Type": f"{content[0][1]}/{content[0][2] if content[0][2] else 'plain'}"
-                }
-            )
-
-        if not content[0][6] and not json.loads(content[0][4]).get("source") == "cda":
-            return redirect(content[0][5])
-        
+            # Without a body, so Content-Length stays the one of the GET response instead of being set to 0
+            return Response(None, status=status, headers=headers, mimetype=mimetype)
+
+        # Media (or at least the requested range of it) on local disk goes straight from the file
+        if data_path:
+            return self.file_response(open(data_path, "rb"), start, end, headers, mimetype, status)
+
+        if self.downloader.chunks.stale(media["id"]):
+            self.downloader.refresh(media["id"]) # Promoted by another worker process since it was resolved
+
+        if self.downloader.chunks.covered(media["id"], start, end):
+            file = self.downloader.chunks.open(media["id"])
+            if file:
+                return self.file_response(file, start, end, headers, mimetype, status)
+
+        stream = generator(media["id"], start, end, size, f"{token or request.remote_addr}:{media['id']}", media["duration"])
+
         return Response(
-            generator(content[0][0], range_start, range_end),
-            headers={
-                "Accept-Ranges": "bytes",
-                "Content-Type": f"{content[0][1]}/{content[0][2] if content[0][2] else 'plain'}",
-                "Content-Length": range_end - range_start if range_end != -1 else await self.downloader.get_content_size(content[0][0]),
-                **({
-                    "Content-Range": f"bytes {range_start}-{range_end - 1 if range_end != -1 else await self.downloader.get_content_size(content[0][0]) - 1}/{await self.downloader.get_content_size(content[0][0])}",
-                } if request.headers.get("Range", None) else {})
-            },
-            mimetype=f"{content[0][1]}/{content[0][2] if content[0][2] else 'plain'}",
-            status=206 if request.headers.get("Range", None) else 200,
+            # Served from the downloader's loop the stream is awaited directly, otherwise it gets a loop of its own
+            stream if self.downloader.in_loop(self.downloader.loop) else iterate_sync(stream),
+            headers=headers,
+            mimetype=mimetype,
+            status=status,
             direct_passthrough=True
         )
\ No newline at end of file